@@ -11,7 +11,9 @@ import os
 import csv
 import math
 import time
+import numpy as np
 from collections import namedtuple
+from classes import load_presents, find_collisions
 
 
 def int_reader_wrapper(reader):
@@ -27,13 +29,8 @@ def readPresentsFile(presentsFilename):
     Returns:
         Dictionary of lists.
     """
-    solution = {}    
-    with open(presentsFilename, 'rb') as f:
-        f.readline() # header
-        fcsv = int_reader_wrapper(csv.reader(f))
-        for row in fcsv:
-            solution[row[0]] = row[1:]
-    return solution
+    presents = load_presents(presentsFilename)
+    return dict(zip(presents[:, 0].tolist(), presents[:, 1:].tolist()))
         
 def readSubmissionFile(submissionFilename):
     """ Read file contents into memory as a dictionary of lists.
@@ -51,6 +48,40 @@ def readSubmissionFile(submissionFilename):
             submission[row[0]] = row[1:]
     return submission
 
+
+
+def read_submission_array(submissionFilename):
+    """ Read the submission file into an (N, 25) integer array.
+    Columns are PresentId, then the x, y, z of the 8 vertices.
+    Parses the whole file with numpy instead of row by row with csv.
+    """
+    with open(submissionFilename, 'rb') as f:
+        f.readline() # header
+        data = f.read().strip()
+    values = np.fromstring(data.replace('\n', ','), dtype=np.int64, sep=',')
+    return values.reshape(-1, 25)
+
+def submission_extents(submission):
+    """ Returns the (N, 3) arrays of the min and max x, y, z of each present
+    in a submission array.
+    """
+    vertices = submission[:, 1:].reshape(-1, 8, 3)
+    return vertices.min(axis=1), vertices.max(axis=1)
+
+def score_submission(submission):
+    """ Calculates the metric for a submission array.
+    Presents are ordered from the top of the sleigh down by their max z,
+    and by present id within the same max z.
+    Returns:
+        metric, height term, order term
+    """
+    presentIds = submission[:, 0]
+    maxZ = submission[:, 3::3].max(axis=1)
+    heightTerm = int(maxZ.max())
+    order = np.lexsort((presentIds, -maxZ))
+    orderTerm = int(np.abs(np.arange(1, len(order) + 1) - presentIds[order]).sum())
+    return 2 * heightTerm + orderTerm, heightTerm, orderTerm
+
         
 Vertex = namedtuple('Vertex', 'x y z')
 class Present:
@@ -246,31 +277,30 @@ if __name__ == "__main__":
     presentsFilename = os.path.join(path, 'presents.csv')
     submissionFilename = os.path.join(path, 'sampleSubmission_bottomPacking.csv')
 
-    # read file contents into solution dictionary and submission dictionary
-    solution = readPresentsFile(presentsFilename)
-    submission = readSubmissionFile(submissionFilename)
+    solution = load_presents(presentsFilename)
+    submission = read_submission_array(submissionFilename)
     print 'contents in memory'
-    
-    # create presents objects, and their order going down sleigh 
-    presents, orderedPresents = GetOrderedPresentsStartingAtTop(solution, submission)
 
-    orderTerm = 0
-    presentsSeenSoFar = 0
-    currentPresentsSet = set()
-    import ipdb; ipdb.set_trace()
-    for zheight in sorted(orderedPresents.iterkeys(), reverse=True):
-        presentsInCrossSection = list(orderedPresents[zheight])
-        presentsInCrossSection.sort()
-        update_current_presents(currentPresentsSet, zheight, presents, presentsInCrossSection)
+    # Check the ids, dimensions, sleigh bounds and collisions, as the Present objects do
+    from validate import check_ids, check_dimensions
+    mins, maxs = submission_extents(submission)
+    duplicates, missing, unknown = check_ids(submission, solution)
+    if len(unknown) or len(duplicates):
+        print 'Submitted packages are not all different presents from the presents file'
+        exit()
+    if len(check_dimensions(submission, mins, maxs, solution)):
+        print 'Submitted packages are not of the expected dimension'
+        exit()
+    if mins[:, :2].min() < 1 or maxs[:, :2].max() > 1000 or mins[:, 2].min() < 1:
+        print 'Submitted packages are not in the sleigh'
+        exit()
+    collisions = find_collisions(np.column_stack([submission[:, 0], mins, maxs]))
+    if len(collisions):
+        print 'Collision detected between presents ' + str(collisions[0, 0]) + ', ' + str(collisions[0, 1])
+        exit()
 
-        # calculate order term on the fly
-        for i in xrange(len(presentsInCrossSection)):
-            presentsSeenSoFar += 1
-            orderTerm += math.fabs(presentsSeenSoFar - presentsInCrossSection[i])
-    
-    metric = 2 * max(orderedPresents.keys()) + orderTerm
+    metric, heightTerm, orderTerm = score_submission(submission)
     print 'Metric = ' + str(metric)
-
     print '\nTotal clock time = ' + str(time.clock() - start)
 
     # orderedPresents is a dictionary with keys of z-height and values of sets
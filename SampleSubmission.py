@@ -14,6 +14,7 @@ Approach:
 
 import os
 import csv
+import classes
 
 SLEIGH_LENGTH = 1000
 
@@ -104,8 +105,15 @@ class Cursor:
         self.pack_along_x = True
 
 
-def reverse_presents():
+def reverse_presents(write=True):
+    """
+    Writes presents.csv in reverse order to presents_revorder.csv
+    If write is False, nothing is written, and the reversed presents are returned
+    as a view on the cached presents array instead
+    """
     presents_filename = os.path.abspath('./data/presents.csv')
+    if not write:
+        return classes.load_presents(presents_filename, reverse=True)
     out_filename = os.path.abspath('./data/presents_revorder.csv')
     with open(presents_filename, 'rb') as infile:
         header = infile.readline()
@@ -0,0 +1,187 @@
+"""
+Benchmarks for the packing algorithms
+
+Generates synthetic present files, runs each Packing class on them in its own process,
+and records the throughput, peak memory and score as JSON, so that runs can be compared.
+
+    python benchmark.py run --n 20000 --distribution mixed --out bench_1.json
+    python benchmark.py compare bench_1.json bench_2.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+import numpy as np
+import run
+import MetricCalculation
+from classes import logger
+
+# Ranges of the present dimensions, and the fraction of presents drawn from each range
+DISTRIBUTIONS = {
+    'small': [(1.0, 2, 70)],
+    'large': [(1.0, 2, 250)],
+    'mixed': [(0.7, 2, 70), (0.3, 2, 250)],
+}
+
+PACKINGS = ['TopDownLayerPacking', 'TopDownMaxRect', 'TopDownArrayMaxRect', 'TopDownMaxRectShortestZ', 'ZMapPacking',
+            'CythonTopDownMaxRect']
+
+
+def generate_presents(filename, n, distribution='mixed', seed=0):
+    """
+    Writes a presents file in the format of presents.csv, with n presents drawn from distribution
+    """
+    rng = np.random.RandomState(seed)
+    parts = DISTRIBUTIONS[distribution]
+    weights = np.array([p[0] for p in parts])
+    which = rng.choice(len(parts), size=n, p=weights / weights.sum())
+    low = np.array([p[1] for p in parts])[which]
+    high = np.array([p[2] for p in parts])[which]
+    dims = low[:, np.newaxis] + (rng.random_sample((n, 3)) * (high - low + 1)[:, np.newaxis]).astype(np.int64)
+    presents = np.column_stack([np.arange(1, n + 1), dims])
+    with open(filename, 'wb') as f:
+        f.write('PresentId,Dimension1,Dimension2,Dimension3\n')
+        np.savetxt(f, presents, fmt='%d', delimiter=',')
+    return filename
+
+
+def get_packing_class(name):
+    if name == 'CythonTopDownMaxRect':
+        import pyximport
+        pyximport.install()
+        import maxrect_cython
+        return maxrect_cython.TopDownMaxRect
+    return getattr(run, name)
+
+
+def _benchmark_worker(name, infile, outfile, queue):
+    packing = get_packing_class(name)()
+    packing.infile = infile
+    packing.outfile = outfile
+    start = time.time()
+    packing.run(check=False, write=False)
+    seconds = time.time() - start
+    packing.write()
+    metric, height_term, order_term = MetricCalculation.score_submission(
+        MetricCalculation.read_submission_array(outfile))
+    queue.put({
+        'seconds': seconds,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'score': metric,
+        'height_term': height_term,
+        'order_term': order_term,
+    })
+
+
+def benchmark_packing(name, infile, n):
+    """
+    Runs one Packing class on infile (relative to the data directory) in a separate process
+    Returns a dict of the results, or None if the packing failed
+    """
+    outfile = os.path.join('data', 'benchmark_{}.csv'.format(name))
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_benchmark_worker, args=(name, infile, outfile, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        logger.error('Benchmark of {} failed'.format(name))
+        return None
+    result = queue.get()
+    result['packing'] = name
+    result['presents_per_second'] = n / result['seconds']
+    os.remove(outfile)
+    return result
+
+
+def run_benchmarks(n, distribution='mixed', seed=0, packings=PACKINGS):
+    infile = 'benchmark_{}_{}_{}.csv'.format(distribution, n, seed)
+    path = os.path.join('data', infile)
+    if not os.path.exists(path):
+        logger.info('Generating {} presents'.format(n))
+        generate_presents(path, n, distribution, seed)
+
+    results = []
+    for name in packings:
+        logger.info('Benchmarking {}'.format(name))
+        result = benchmark_packing(name, infile, n)
+        if result is not None:
+            logger.info('{packing}: {seconds:.1f} s, {presents_per_second:.0f} presents/s, '
+                        '{peak_rss_mb:.0f} MB, score {score}'.format(**result))
+            results.append(result)
+    return {
+        'n': n,
+        'distribution': distribution,
+        'seed': seed,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+
+
+def compare(old, new, tolerance=0.1):
+    """
+    Compares two benchmark runs
+    Returns a list of regressions: a packing that got more than tolerance slower or bigger,
+    or whose score got worse, and a list of the packings whose score got better.  Lower scores are better
+    """
+    if (old['n'], old['distribution'], old['seed']) != (new['n'], new['distribution'], new['seed']):
+        logger.warn('Benchmarks were run on different inputs')
+    old_results = dict((r['packing'], r) for r in old['results'])
+    regressions = []
+    improvements = []
+    for result in new['results']:
+        before = old_results.get(result['packing'])
+        if before is None:
+            continue
+        for key in ('seconds', 'peak_rss_mb'):
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append('{}: {} went from {:.1f} to {:.1f}'.format(
+                    result['packing'], key, before[key], result[key]))
+        change = '{}: score went from {} to {}'.format(result['packing'], before['score'], result['score'])
+        if result['score'] > before['score']:
+            regressions.append(change)
+        elif result['score'] < before['score']:
+            improvements.append(change)
+    return regressions, improvements
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--n', type=int, default=10000, help='Number of presents')
+    run_parser.add_argument('--distribution', default='mixed', choices=sorted(DISTRIBUTIONS))
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--packings', nargs='+', default=PACKINGS, choices=PACKINGS)
+    run_parser.add_argument('--out', default='benchmark.json', help='JSON file to write the results to')
+    compare_parser = commands.add_parser('compare', help='Compare two benchmark result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(args.n, args.distribution, args.seed, args.packings)
+        with open(args.out, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info('Results written to {}'.format(args.out))
+    else:
+        with open(args.old, 'rb') as f:
+            old = json.load(f)
+        with open(args.new, 'rb') as f:
+            new = json.load(f)
+        regressions, improvements = compare(old, new, args.tolerance)
+        for regression in regressions:
+            print regression
+        if not regressions:
+            print 'No regressions'
+        if improvements:
+            print 'Improvements:'
+            for improvement in improvements:
+                print improvement
+        exit(1 if regressions else 0)
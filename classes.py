@@ -1,8 +1,13 @@
 """
 Classes for Sleigh packing problem.
 """
+import atexit
 import csv
+import os
 import itertools
+import json
+import shutil
+import tempfile
 import collections
 import math
 import numpy as np
@@ -34,6 +39,50 @@ def create_header():
     return header
 
 
+def presents_cache_path(presents_file):
+    return presents_file + '.npy'
+
+
+def presents_cache_key(presents_file):
+    stat = os.stat(presents_file)
+    return '{} {}'.format(stat.st_size, int(stat.st_mtime))
+
+
+def load_presents(presents_file, reverse=False):
+    """
+    Returns an (N, 4) int32 array of pid, dim1, dim2, dim3 from a presents csv file
+
+    The csv is only parsed the first time.  The parsed array is cached next to the csv as an .npy file,
+    together with a .key file holding the size and mtime of the csv it was built from.
+    Later calls memory-map the cache, so the array is read-only.
+    If reverse is True, a reversed view of the array is returned, without copying.
+    """
+    cache_file = presents_cache_path(presents_file)
+    key_file = cache_file + '.key'
+    key = presents_cache_key(presents_file)
+    cached_key = None
+    if os.path.exists(cache_file) and os.path.exists(key_file):
+        with open(key_file, 'rb') as f:
+            cached_key = f.read().strip()
+
+    if cached_key != key:
+        logger.info('Parsing {}'.format(presents_file))
+        presents = np.loadtxt(presents_file, dtype=np.int32, delimiter=',', skiprows=1, ndmin=2)
+        # Write to a temporary file first, so an interrupted write never leaves a corrupt cache behind
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, presents)
+        os.rename(tmp_file, cache_file)
+        with open(key_file, 'wb') as f:
+            f.write(key)
+        logger.info('Cached {} presents to {}'.format(len(presents), cache_file))
+
+    presents = np.load(cache_file, mmap_mode='r')
+    if reverse:
+        presents = presents[::-1]
+    return presents
+
+
 class Present(object):
     """
     A Present to be packed in the sleigh
@@ -58,7 +107,7 @@ class Present(object):
         """
         Compare if the present has the same id and is of the same size as other
         """
-        if not isinstance(other, Present):
+        if not isinstance(other, (Present, PresentView)):
             raise TypeError("{} is not an instance of Present".format(other))
         return (self.pid == other.pid) and (self.dimensions == other.dimensions)
 
@@ -168,23 +217,631 @@ class Present(object):
             self.update_extents()
 
 
+class PresentTable(object):
+    """
+    Columnar store for a collection of Presents
+
+    The pids and the dimensions as read are kept as they are passed in, without copying them, so tables in several
+    processes can share them, e.g. from shared_presents.  Only the placements are stored per table, in an (N, 9) int32
+    array, one row per present.  The columns are the dimensions as oriented (x, y, z), the position (x1, y1, z1)
+    and the opposite corner (x2, y2, z2).
+    Iterating over the table or indexing it by pid returns PresentView handles,
+    which behave like Present objects but read and write the table directly.
+    """
+    DIMS = slice(0, 3)
+    POSITION = slice(3, 6)
+    CORNER = slice(6, 9)
+    N_COLUMNS = 9
+
+    def __init__(self, dimensions):
+        """
+        dimensions is an (N, 4) array of pid, dim1, dim2, dim3, as in presents.csv
+        """
+        dimensions = np.asarray(dimensions, dtype=np.int32).reshape(-1, 4)
+        self._dimensions = dimensions
+        self._pids = dimensions[:, 0]
+        self._data = np.empty((len(dimensions), self.N_COLUMNS), dtype=np.int32)
+        self._data[:, self.DIMS] = dimensions[:, 1:]
+        self._data[:, self.POSITION] = 1
+        self._data[:, self.CORNER] = self._data[:, self.DIMS]
+        self._rows_by_pid = None
+
+    @classmethod
+    def from_csv(cls, filename, reverse=False):
+        logger.info('Loading presents from {}'.format(filename))
+        table = cls(load_presents(filename, reverse=reverse))
+        logger.info('Loaded {} Presents'.format(len(table)))
+        return table
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        for row in xrange(len(self._data)):
+            yield PresentView(self._data, self._pids, row)
+
+    def __getitem__(self, pid):
+        """
+        Get the present with the given id
+        """
+        row = self.row_of(pid)
+        if row is None:
+            raise KeyError(pid)
+        return PresentView(self._data, self._pids, row)
+
+    def __contains__(self, pid):
+        return self.row_of(pid) is not None
+
+    def row_of(self, pid):
+        """
+        Returns the row index of the present with the given id, or None if it isn't in the table
+        """
+        if self._rows_by_pid is None:
+            pids = self.pid
+            order = np.argsort(pids, kind='mergesort')
+            self._rows_by_pid = (pids[order], order)
+        sorted_pids, order = self._rows_by_pid
+        i = np.searchsorted(sorted_pids, pid)
+        if i < len(sorted_pids) and sorted_pids[i] == pid:
+            return int(order[i])
+        return None
+
+    def view(self, row):
+        return PresentView(self._data, self._pids, row)
+
+    def rotate_shortest_z(self):
+        """
+        Same rotations as Present.rotate_shortest_z, on all of the presents at once
+        """
+        x, y, z = self.dims.T.copy()
+        rotate = ~((z < y) & (z < x))
+        swap_x = rotate & (x < y)
+        swap_y = rotate & ~(x < y)
+        dims = np.column_stack([np.where(swap_x, z, x), np.where(swap_y, z, y), np.where(swap_x, x, np.where(swap_y, y, z))])
+        self.set_placements(np.arange(len(self)), dims, self.positions.copy())
+
+    def set_placements(self, rows, dims, positions):
+        """
+        Sets the orientation and position of the presents in rows
+        dims and positions are (len(rows), 3) arrays
+        """
+        self._data[rows, self.DIMS] = dims
+        self._data[rows, self.POSITION] = positions
+        self._data[rows, self.CORNER] = np.asarray(positions) + dims - 1
+
+    @property
+    def pid(self):
+        return self._pids
+
+    @property
+    def original_dims(self):
+        """
+        Dimensions of the presents as they were read, before any rotation
+        """
+        return self._dimensions[:, 1:]
+
+    @property
+    def dims(self):
+        return self._data[:, self.DIMS]
+
+    @property
+    def positions(self):
+        return self._data[:, self.POSITION]
+
+    @property
+    def opposite_corners(self):
+        return self._data[:, self.CORNER]
+
+
+class PresentView(object):
+    """
+    Handle on a single row of a PresentTable.
+    Has the same interface as Present, but only stores a reference to the table data and a row index
+    """
+    __slots__ = ('_data', '_pids', '_row')
+
+    def __init__(self, data, pids, row):
+        self._data = data
+        self._pids = pids
+        self._row = row
+
+    def __repr__(self):
+        return "Present #{}: {}, {}, {}".format(self.pid, self.x, self.y, self.z)
+
+    def __eq__(self, other):
+        """
+        Compare if the present has the same id and is of the same size as other
+        """
+        if not isinstance(other, (Present, PresentView)):
+            raise TypeError("{} is not an instance of Present".format(other))
+        return (self.pid == other.pid) and (self.dimensions == other.dimensions)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @property
+    def row(self):
+        return self._row
+
+    @property
+    def pid(self):
+        return self._pids.item(self._row)
+
+    @property
+    def x(self):
+        return self._data.item(self._row, 0)
+
+    @property
+    def y(self):
+        return self._data.item(self._row, 1)
+
+    @property
+    def z(self):
+        return self._data.item(self._row, 2)
+
+    @property
+    def x1(self):
+        return self._data.item(self._row, 3)
+
+    @property
+    def y1(self):
+        return self._data.item(self._row, 4)
+
+    @property
+    def z1(self):
+        return self._data.item(self._row, 5)
+
+    @property
+    def x2(self):
+        return self._data.item(self._row, 6)
+
+    @property
+    def y2(self):
+        return self._data.item(self._row, 7)
+
+    @property
+    def z2(self):
+        return self._data.item(self._row, 8)
+
+    # Dimensions are always positive, so the first corner is always the minimum
+    xmin = x1
+    ymin = y1
+    zmin = z1
+    xmax = x2
+    ymax = y2
+    zmax = z2
+
+    @property
+    def dimensions(self):
+        return set(self._data[self._row, :3].tolist())
+
+    @property
+    def position(self):
+        return tuple(self._data[self._row, 3:6].tolist())
+
+    @position.setter
+    def position(self, position):
+        x, y, z = self._data[self._row, :3].tolist()
+        self._data[self._row, 3:9] = (position[0], position[1], position[2],
+                                       position[0] + x - 1, position[1] + y - 1, position[2] + z - 1)
+
+    @property
+    def opposite_corner(self):
+        return tuple(self._data[self._row, 6:9].tolist())
+
+    @property
+    def vertices(self):
+        """
+        Eight vertices of the Present, following the same convention as Present.vertices
+        """
+        x1, y1, z1, x2, y2, z2 = self._data[self._row, 3:9].tolist()
+        return [
+            x1, y1, z1,
+            x1, y2, z1,
+            x2, y1, z1,
+            x2, y2, z1,
+            x1, y1, z2,
+            x1, y2, z2,
+            x2, y1, z2,
+            x2, y2, z2
+        ]
+
+    def contains_xy(self, otherPresent):
+        """
+        Checks on the x,y plane if otherPresent is fully contained in this present
+        """
+        return otherPresent.xmin >= self.xmin and otherPresent.ymin >= self.ymin and \
+               otherPresent.xmax <= self.xmax and otherPresent.ymax <= self.ymax
+
+    def overlaps_xy(self, otherPresent):
+        """
+        Checks on the x,y plane if otherPresent overlaps with this present
+        """
+        if (self.xmax < otherPresent.xmin) or (otherPresent.xmax < self.xmin):
+            return False
+        if (self.ymax < otherPresent.ymin) or (otherPresent.ymax < self.ymin):
+            return False
+        return True
+
+    def set_dimensions(self, x, y, z):
+        """
+        Re-orients the present.  Keeps the position and updates the opposite corner
+        """
+        x1, y1, z1 = self._data[self._row, 3:6].tolist()
+        self._data[self._row, :3] = (x, y, z)
+        self._data[self._row, 6:9] = (x1 + x - 1, y1 + y - 1, z1 + z - 1)
+
+    def rotate_xy(self):
+        """
+        Rotates the present along the z-axis.  Basically swaps x and y lengths
+        """
+        x, y, z = self._data[self._row, :3].tolist()
+        self.set_dimensions(y, x, z)
+
+    def rotate_shortest_z(self):
+        """
+        Rotates the present so that the z dimension is the shortest
+        """
+        x, y, z = self._data[self._row, :3].tolist()
+        if not (z < y and z < x):
+            if x < y:
+                self.set_dimensions(z, y, x)
+            else:
+                self.set_dimensions(x, z, y)
+
+
 def get_all_presents():
     """
-    Factory function that returns a dict that contains all presents
-    Keys are IDs, values are Present objects
+    Factory function that returns a PresentTable that contains all presents
+    Indexing the table by ID returns a PresentView
     """
     presents_file = './data/presents.csv'
-    res = {}
     logger.info('Loading all presents')
-    with open(presents_file, 'rb') as presents:
-        presents.readline() # skip header
-        read = csv.reader(presents)
-        for row in read:
-            present = Present(*row)
-            res[present.pid] = present
-            if len(res) % 100000 == 0:
-                logger.info('Loaded {} Presents'.format(len(res)))
-    return res
+    return PresentTable.from_csv(presents_file)
+
+
+def presents_to_boxes(presents):
+    """
+    Returns an (N, 7) int array of pid, x1, y1, z1, x2, y2, z2 for an iterable of presents
+    Views of a single PresentTable are read straight from the table.
+    """
+    presents = list(presents)
+    data = getattr(presents[0], '_data', None) if presents else None
+    if data is not None and all(getattr(p, '_data', None) is data for p in presents):
+        rows = np.fromiter((p.row for p in presents), dtype=np.int64, count=len(presents))
+        return np.column_stack([presents[0]._pids[rows], data[rows, 3:9]]).astype(np.int64)
+    boxes = [(p.pid, p.xmin, p.ymin, p.zmin, p.xmax, p.ymax, p.zmax) for p in presents]
+    return np.array(boxes, dtype=np.int64).reshape(-1, 7)
+
+
+def boxes_to_rows(boxes):
+    """
+    Returns the (N, 25) rows of a submission file, pid and the eight vertices, for (N, 7) boxes
+    Follows the vertex convention of Present.vertices
+    """
+    pid, x1, y1, z1, x2, y2, z2 = np.asarray(boxes).T
+    return np.column_stack([
+        pid,
+        x1, y1, z1,
+        x1, y2, z1,
+        x2, y1, z1,
+        x2, y2, z1,
+        x1, y1, z2,
+        x1, y2, z2,
+        x2, y1, z2,
+        x2, y2, z2
+    ])
+
+
+def format_rows(rows, delimiter=',', newline='\r\n'):
+    """
+    Formats a 2D int array as delimited text, the same as csv.writer does
+    The digits of all of the values are worked out at once, instead of formatting each value in Python.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    n, m = rows.shape
+    if rows.size == 0:
+        return ''
+    values = np.abs(rows).ravel()
+    largest = values.max()
+    # One column for each digit, plus one spare for the minus sign
+    width = len(str(largest)) + 1
+    chars = np.empty((values.size, width + 1), dtype=np.uint8)
+    keep = np.empty((values.size, width + 1), dtype=bool)
+    remaining = values.astype(np.uint32 if largest < 2 ** 32 else np.uint64)
+    for column in xrange(width - 1, -1, -1):
+        keep[:, column] = remaining > 0
+        remaining, digit = np.divmod(remaining, 10)
+        chars[:, column] = digit
+    chars += ord('0')
+    # Zero still needs one digit
+    keep[:, width - 1] = True
+    negative = np.flatnonzero(rows.ravel() < 0)
+    if len(negative):
+        sign = width - 1 - keep[negative, :width].sum(axis=1)
+        chars[negative, sign] = ord('-')
+        keep[negative, sign] = True
+    chars[:, width] = ord(delimiter)
+    keep[:, width] = True
+
+    # Replace the delimiter after the last value of each row with the newline
+    chars = chars.reshape(n, -1)[:, :-1]
+    keep = keep.reshape(n, -1)[:, :-1]
+    newline = np.tile(np.fromstring(newline, dtype=np.uint8), (n, 1))
+    chars = np.column_stack([chars, newline])
+    keep = np.column_stack([keep, np.ones(newline.shape, dtype=bool)])
+    return chars[keep].tostring()
+
+
+def write_submission(outfile, boxes, descending=True, chunk_size=100000):
+    """
+    Writes (N, 7) boxes to a submission file, sorted by pid
+    The rows are built and formatted chunk_size at a time, to bound memory.
+    Returns the number of presents written
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 7)
+    order = np.argsort(boxes[:, 0])
+    if descending:
+        order = order[::-1]
+    chunks = (boxes[order[start:start + chunk_size]] for start in xrange(0, len(order), chunk_size))
+    return write_submission_chunks(outfile, chunks)
+
+
+def score_boxes(boxes):
+    """
+    Height term and order term of the metric for an (N, 7) array of pid, x1, y1, z1, x2, y2, z2
+    Presents are ordered from the top of the sleigh down by their max z, and by present id within the same max z.
+    """
+    if not len(boxes):
+        return 0, 0
+    pids = boxes[:, 0].astype(np.int64)
+    zmax = boxes[:, 6]
+    order = np.lexsort((pids, -zmax))
+    return int(zmax.max()), int(np.abs(np.arange(1, len(order) + 1) - pids[order]).sum())
+
+
+def write_submission_chunks(outfile, chunks):
+    """
+    Writes an iterable of (M, 7) box arrays to a submission file, in the order given
+    Returns the number of presents written
+    """
+    count = 0
+    with open(outfile, 'wb') as out:
+        out.write(','.join(create_header()) + '\r\n')
+        for boxes in chunks:
+            out.write(format_rows(boxes_to_rows(boxes)))
+            count += len(boxes)
+    return count
+
+
+class SleighCheckpoint(object):
+    """
+    Saves the layers of a LayerSleigh as they are added, so that a packing can be picked up again after it stops
+
+    layers.bin has a record per layer: z, max z and the number of presents, then row, x, y, z, x1, y1, z1 of each
+    present, all int32.  Each save only appends the layers added since the last one.
+    state.json has the running totals of the sleigh, the state of the packing, and the length of layers.bin
+    it goes with.  It is replaced in one rename, so a save that is interrupted part way is ignored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.layers_path = os.path.join(directory, 'layers.bin')
+        self.state_path = os.path.join(directory, 'state.json')
+        self._pending = []
+
+    def clear(self):
+        for path in (self.layers_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._pending = []
+
+    def record(self, layer):
+        """
+        Keeps a layer in its final position, to be written with the next save
+        """
+        presents = layer.presents.values()
+        placements = np.array([(p.row, p.x, p.y, p.z) + p.position for p in presents], dtype=np.int32).reshape(-1, 7)
+        header = np.array([layer.z, layer.max_z, len(placements)], dtype=np.int32)
+        self._pending.append(header.tostring() + placements.tostring())
+
+    def save(self, sleigh, **state):
+        """
+        Appends the new layers and writes the state
+        state is anything else the packing needs to carry on, and has to be JSON serializable
+        """
+        with open(self.layers_path, 'ab') as f:
+            f.write(''.join(self._pending))
+            f.flush()
+            os.fsync(f.fileno())
+            layers_bytes = f.tell()
+        self._pending = []
+        state = {
+            'layers_bytes': layers_bytes,
+            'sleigh': dict((name, getattr(sleigh, name)) for name in sleigh.checkpoint_fields),
+            'packing': state,
+        }
+        temporary = self.state_path + '.tmp'
+        with open(temporary, 'wb') as f:
+            json.dump(state, f)
+        os.rename(temporary, self.state_path)
+        logger.info("Checkpoint saved with {} layers".format(sleigh.n_layers))
+
+    def restore(self, sleigh, presents):
+        """
+        Puts the saved layers back into sleigh, and their placements into the PresentTable presents
+        Returns the state of the packing passed to save
+        """
+        with open(self.state_path, 'rb') as f:
+            state = json.load(f)
+        # Drop anything appended after the last save
+        with open(self.layers_path, 'r+b') as f:
+            f.truncate(state['layers_bytes'])
+        data = np.fromfile(self.layers_path, dtype=np.int32)
+        offset = 0
+        while offset < len(data):
+            z, max_z, n = data[offset:offset + 3].tolist()
+            placements = data[offset + 3:offset + 3 + 7 * n].reshape(n, 7)
+            offset += 3 + 7 * n
+            presents.set_placements(placements[:, 0], placements[:, 1:4], placements[:, 4:7])
+            layer = Layer(z=z)
+            layer.max_z = max_z
+            for row in placements[:, 0].tolist():
+                present = presents.view(row)
+                layer.presents[present.position] = present
+            sleigh.keep_layer(layer)
+        for name, value in state['sleigh'].items():
+            setattr(sleigh, name, value)
+        logger.info("Restored {} layers from checkpoint".format(sleigh.n_layers))
+        return state['packing']
+
+
+class LayerSpill(object):
+    """
+    Closed layers written to disk as runs of boxes sorted by pid, so they don't have to be kept in memory
+
+    The boxes are buffered until there are run_size of them, then sorted and saved as one run,
+    which keeps the number of runs to merge small.  The files are removed when the process exits.
+    """
+
+    def __init__(self, directory=None, run_size=100000):
+        self.directory = tempfile.mkdtemp(prefix='sleigh_', dir=directory)
+        atexit.register(shutil.rmtree, self.directory, True)
+        self.run_size = run_size
+        self.runs = []
+        self.count = 0
+        # Added to the z coordinates of the boxes when they are read back
+        self.z_shift = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, boxes):
+        """
+        Adds (M, 7) boxes of pid, x1, y1, z1, x2, y2, z2
+        """
+        self._buffer.append(np.asarray(boxes, dtype=np.int32).reshape(-1, 7))
+        self._buffered += len(boxes)
+        self.count += len(boxes)
+        if self._buffered >= self.run_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Saves the buffered boxes as a run
+        """
+        if not self._buffered:
+            return
+        boxes = np.concatenate(self._buffer)
+        boxes = boxes[np.argsort(boxes[:, 0])]
+        path = os.path.join(self.directory, 'run_{}.npy'.format(len(self.runs)))
+        np.save(path, boxes)
+        self.runs.append(path)
+        self._buffer = []
+        self._buffered = 0
+
+    def _shifted(self, boxes):
+        boxes = np.array(boxes, dtype=np.int64)
+        boxes[:, 3] += self.z_shift
+        boxes[:, 6] += self.z_shift
+        return boxes
+
+    def boxes(self):
+        """
+        All of the boxes, in no particular order
+        """
+        self.flush()
+        if not self.runs:
+            return np.empty((0, 7), dtype=np.int64)
+        return self._shifted(np.concatenate([np.load(path) for path in self.runs]))
+
+    def merged(self, descending=True, chunk_size=100000):
+        """
+        Yields all of the boxes sorted by pid, in chunks, with a k-way merge of the runs
+
+        A block is read from each run.  Every box up to the smallest last pid of the blocks
+        has already been read, so those boxes can be sorted and yielded, and the rest wait for the next round.
+        At most chunk_size boxes are read at a time.
+        """
+        self.flush()
+        runs = [np.load(path, mmap_mode='r') for path in self.runs]
+        if descending:
+            runs = [run[::-1] for run in runs]
+        # Keys increase along every run
+        sign = -1 if descending else 1
+        block = max(chunk_size // max(len(runs), 1), 1)
+        starts = [0] * len(runs)
+        while True:
+            live = [i for i in xrange(len(runs)) if starts[i] < len(runs[i])]
+            if not live:
+                break
+            blocks = dict((i, runs[i][starts[i]:starts[i] + block]) for i in live)
+            bound = min(sign * int(blocks[i][-1, 0]) for i in live)
+            parts = []
+            for i in live:
+                n = np.searchsorted(sign * blocks[i][:, 0], bound, side='right')
+                parts.append(blocks[i][:n])
+                starts[i] += n
+            boxes = np.concatenate(parts)
+            yield self._shifted(boxes[np.argsort(sign * boxes[:, 0])])
+
+
+def find_collisions(boxes, cell_size=100, max_pairs=4000000):
+    """
+    Finds all pairs of boxes that overlap in 3D
+    boxes is an (N, 7) array of pid, x1, y1, z1, x2, y2, z2, with inclusive coordinates.
+    Returns an (M, 2) array of the pids of the colliding pairs.
+
+    The x,y plane is cut into a grid of cell_size x cell_size cells, and each box is entered into every cell it covers.
+    Boxes outside of the sleigh go in the cells on the edge, so nothing is assumed about the bounds.
+    Within each cell, the boxes are swept bottom to top, and each box is only compared with the boxes
+    that start between its bottom and top.  A pair is only reported in the cell
+    that holds the bottom left corner of the overlap, so it is reported once.
+    The candidate pairs are checked max_pairs at a time, to bound memory.
+    """
+    boxes = np.asarray(boxes, dtype=np.int64)
+    if len(boxes) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    pid, x1, y1, z1, x2, y2, z2 = boxes.T
+    n_cells = (max(MAX_X, MAX_Y) - 1) // cell_size + 1
+
+    def cell_of(coord):
+        return np.clip((coord - 1) // cell_size, 0, n_cells - 1)
+
+    # Enter each box into each of the cells it covers
+    cx1, cy1, cx2, cy2 = cell_of(x1), cell_of(y1), cell_of(x2), cell_of(y2)
+    widths = cx2 - cx1 + 1
+    counts = widths * (cy2 - cy1 + 1)
+    box = np.repeat(np.arange(len(boxes)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell = (cx1[box] + offset % widths[box]) * n_cells + cy1[box] + offset // widths[box]
+
+    # Sort the entries by cell, then by bottom z
+    z_base = z1.min()
+    z_span = z2.max() - z_base + 1
+    keys = cell * z_span + (z1[box] - z_base)
+    order = np.argsort(keys, kind='mergesort')
+    box, cell, keys = box[order], cell[order], keys[order]
+    # Entries from this one up to the end start below this box's top, in the same cell
+    ends = np.searchsorted(keys, cell * z_span + (z2[box] - z_base), side='right')
+    n_candidates = ends - np.arange(len(box)) - 1
+
+    collisions = []
+    start = 0
+    while start < len(box):
+        # Take as many entries as fit into max_pairs candidate pairs, but always at least one
+        stop = start + max(1, np.searchsorted(np.cumsum(n_candidates[start:]), max_pairs, side='right'))
+        counts = n_candidates[start:stop]
+        first = np.repeat(np.arange(start, stop), counts)
+        second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        a, b = box[first], box[second]
+        overlaps = (x1[a] <= x2[b]) & (x1[b] <= x2[a]) & (y1[a] <= y2[b]) & (y1[b] <= y2[a])
+        corner_cell = cell_of(np.maximum(x1[a], x1[b])) * n_cells + cell_of(np.maximum(y1[a], y1[b]))
+        found = overlaps & (corner_cell == cell[first])
+        collisions.append(np.column_stack([pid[a[found]], pid[b[found]]]))
+        start = stop
+    return np.vstack(collisions)
 
 
 class Layer(object):
@@ -261,15 +918,34 @@ class Layer(object):
         self.cursor.x = self.max_x + 1  # add 1, since coordinates indicate a filled cell in the sleigh
         return True
 
+    def free_space(self):
+        """
+        Free area of the layer, and the largest width, depth and shortest side of its free rectangles,
+        for layers that keep track of them, otherwise None
+        """
+        return None
+
+    def could_fit(self, present):
+        """
+        False if present can't fit in the layer either way round, known without searching for a place for it.  O(1)
+        Always True for layers without free_space.
+        """
+        space = self.free_space()
+        if space is None:
+            return True
+        free_area, max_width, max_depth, max_short_side = space
+        width, depth = present.x, present.y
+        if width * depth > free_area or (width if width < depth else depth) > max_short_side:
+            return False
+        return (width <= max_width and depth <= max_depth) or (depth <= max_width and width <= max_depth)
+
     def check_collisions(self):
-        # This is really slow right now
-        # Ensure that no presents overlap on the xy plane
-        for p1, p2 in itertools.combinations(self.presents.values(), 2):
-            if p1.overlaps_xy(p2):
-                logger.info('Present {} overlaps with present {}'.format(p1.pid, p2.pid))
-                self._errors.append('Present {} overlaps with present {}'.format(p1.pid, p2.pid))
-                return False
-        return True
+        # Ensure that no presents overlap
+        collisions = find_collisions(presents_to_boxes(self.presents.values()))
+        for pid1, pid2 in collisions.tolist():
+            logger.info('Present {} overlaps with present {}'.format(pid1, pid2))
+            self._errors.append('Present {} overlaps with present {}'.format(pid1, pid2))
+        return len(collisions) == 0
 
     def flip_layer(self):
         """
@@ -314,15 +990,371 @@ class Layer(object):
         self.z += diff
 
 
+class FreeRectangleIndex(object):
+    """
+    Ordered collection of free rectangles with a spatial index on the x,y plane
+
+    The rectangles are kept in a linked list, so a rectangle can be replaced by its splits in place
+    and iteration order is the same as with a plain list.
+    Each rectangle is also registered in the buckets of a uniform grid over the MAX_X x MAX_Y plane,
+    so overlap and containment queries only look at rectangles near the one being queried,
+    and in the row of the grid its bottom edge is in, so bottom_left can look at the lowest rectangles first.
+    Rectangles are referred to by an integer id.  Each has an order key, increasing along the list,
+    to compare positions in the ordering with.
+    The widest and deepest free rectangles, and the longest short side of a free rectangle, are kept track of
+    with counts of the rectangles of each length of side.
+    """
+    cell_size = 50
+    _head = -1
+
+    def __init__(self):
+        self._rects = {}
+        self._next = {self._head: self._head}
+        self._prev = {self._head: self._head}
+        # Keys are (cell x, cell y), values are sets of rectangle ids
+        self._cells = collections.defaultdict(set)
+        # Keys are grid rows, values are sets of the ids of the rectangles with their bottom edge in the row
+        self._rows = collections.defaultdict(set)
+        self._order = {}
+        self._next_id = 0
+        self._width_counts = [0] * (MAX_X + 1)
+        self._depth_counts = [0] * (MAX_Y + 1)
+        self._short_side_counts = [0] * (min(MAX_X, MAX_Y) + 1)
+        self.max_width = 0
+        self.max_depth = 0
+        self.max_short_side = 0
+
+    def __len__(self):
+        return len(self._rects)
+
+    def __iter__(self):
+        rid = self._next[self._head]
+        while rid != self._head:
+            yield self._rects[rid]
+            rid = self._next[rid]
+
+    def __getitem__(self, rid):
+        return self._rects[rid]
+
+    def _cell_range(self, rect):
+        cell = self.cell_size
+        return (xrange((max(rect.xmin, 1) - 1) // cell, (min(rect.xmax, MAX_X) - 1) // cell + 1),
+                xrange((max(rect.ymin, 1) - 1) // cell, (min(rect.ymax, MAX_Y) - 1) // cell + 1))
+
+    def _order_before(self, rid):
+        """
+        Order key for a rectangle inserted just in front of the rectangle rid
+        """
+        prev = self._prev[rid]
+        before = self._order[prev] if prev != self._head else None
+        if rid == self._head:
+            return 1.0 if before is None else before + 1.0
+        after = self._order[rid]
+        if before is None:
+            before = after - 1.0
+        key = (before + after) / 2
+        if before < key < after:
+            return key
+        # The keys ran out of precision between the neighbours, so number the rectangles again
+        other = self._next[self._head]
+        key = 1.0
+        while other != self._head:
+            self._order[other] = key
+            key += 1.0
+            other = self._next[other]
+        return self._order_before(rid)
+
+    def _insert_before(self, rid, rect):
+        """
+        Adds rect to the index, just in front of the rectangle rid
+        """
+        new_id = self._next_id
+        self._next_id += 1
+        self._rects[new_id] = rect
+        self._order[new_id] = self._order_before(rid)
+        prev = self._prev[rid]
+        self._next[prev] = new_id
+        self._prev[new_id] = prev
+        self._next[new_id] = rid
+        self._prev[rid] = new_id
+        xcells, ycells = self._cell_range(rect)
+        for i in xcells:
+            for j in ycells:
+                self._cells[(i, j)].add(new_id)
+        self._rows[(rect.ymin - 1) // self.cell_size].add(new_id)
+        width, depth = rect.x, rect.y
+        short_side = width if width < depth else depth
+        self._width_counts[width] += 1
+        self._depth_counts[depth] += 1
+        self._short_side_counts[short_side] += 1
+        if width > self.max_width:
+            self.max_width = width
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if short_side > self.max_short_side:
+            self.max_short_side = short_side
+        return new_id
+
+    def append(self, rect):
+        return self._insert_before(self._head, rect)
+
+    def replace(self, rid, rects):
+        """
+        Replaces the rectangle rid with rects, in the same position in the ordering.  Returns the new ids
+        """
+        new_ids = [self._insert_before(rid, rect) for rect in rects]
+        self.remove(rid)
+        return new_ids
+
+    def remove(self, rid):
+        rect = self._rects.pop(rid)
+        del self._order[rid]
+        prev = self._prev.pop(rid)
+        nxt = self._next.pop(rid)
+        self._next[prev] = nxt
+        self._prev[nxt] = prev
+        xcells, ycells = self._cell_range(rect)
+        for i in xcells:
+            for j in ycells:
+                self._cells[(i, j)].discard(rid)
+        self._rows[(rect.ymin - 1) // self.cell_size].discard(rid)
+        width, depth = rect.x, rect.y
+        self._width_counts[width] -= 1
+        self._depth_counts[depth] -= 1
+        self._short_side_counts[width if width < depth else depth] -= 1
+        # Splits are smaller than the rectangle they came from, so the maximums only go down, a step at a time
+        while self.max_width and not self._width_counts[self.max_width]:
+            self.max_width -= 1
+        while self.max_depth and not self._depth_counts[self.max_depth]:
+            self.max_depth -= 1
+        while self.max_short_side and not self._short_side_counts[self.max_short_side]:
+            self.max_short_side -= 1
+
+    def bottom_left(self, width, depth):
+        """
+        Finds where a width x depth rectangle goes by the bottom left rule: the placement, as is or rotated,
+        in the bottom left corner of a free rectangle with the lowest top, and of those the one in the earliest
+        rectangle in the ordering.  Returns (rectangle id, rotated), or None if it doesn't fit anywhere.
+
+        The rows of the grid are walked bottom up, stopping at the first row that can't have a placement
+        as low as the best one found.
+        """
+        short_side = width if width < depth else depth
+        cell = self.cell_size
+        rects = self._rects
+        order = self._order
+        chosen = None
+        best_y = MAX_Y + 1
+        best_order = None
+        for row in xrange((MAX_Y - 1) // cell + 1):
+            # The lowest placement in the row has its bottom on the first line of the row
+            if row * cell + short_side > best_y:
+                break
+            for rid in self._rows.get(row, ()):
+                rect = rects[rid]
+                y = None
+                if width <= rect.x and depth <= rect.y:
+                    y = rect.y1 + depth - 1
+                    rotated = False
+                # Only take the rotated placement if it's lower, as the present keeps its orientation on a tie
+                if depth <= rect.x and width <= rect.y and (y is None or width < depth):
+                    y = rect.y1 + width - 1
+                    rotated = True
+                if y is None or y > best_y or (y == best_y and order[rid] > best_order):
+                    continue
+                chosen = (rid, rotated)
+                best_y = y
+                best_order = order[rid]
+        return chosen
+
+    def overlapping(self, present):
+        """
+        Returns the ids of the rectangles that overlap present on the x,y plane
+        """
+        candidates = set()
+        xcells, ycells = self._cell_range(present)
+        for i in xcells:
+            for j in ycells:
+                candidates.update(self._cells.get((i, j), ()))
+        return [rid for rid in candidates if present.overlaps_xy(self._rects[rid])]
+
+    def is_contained(self, rid):
+        """
+        Checks if the rectangle rid is fully contained in another rectangle.
+        Identical rectangles do not count as containing each other.
+        """
+        r1 = self._rects[rid]
+        # Any rectangle containing r1 also covers the cell of r1's bottom left corner
+        cell = ((r1.xmin - 1) // self.cell_size, (r1.ymin - 1) // self.cell_size)
+        for other in self._cells.get(cell, ()):
+            if other == rid:
+                continue
+            r2 = self._rects[other]
+            if (r1.x1, r1.y1, r1.x2, r1.y2) == (r2.x1, r2.y1, r2.x2, r2.y2):
+                continue
+            if (r1.xmin >= r2.xmin and r1.ymin >= r2.ymin) and \
+                    (r1.xmax <= r2.xmax and r1.ymax <= r2.ymax):
+                return True
+        return False
+
+
+class PlacementHeuristic(object):
+    """
+    Scores the placements of a present in the free rectangles of a MaxRects layer
+
+    score gets a (K, 4) array of the free rectangles, x1, y1, x2, y2, and the width and depth of the present,
+    and returns a (K, 2) array of scores for putting the present in the bottom left corner of each rectangle,
+    as is and rotated.  Lower is better.  The scores of placements that don't fit are ignored.
+    All of the placements are scored in one call, so heuristics should use array operations.
+    """
+
+    def score(self, rects, width, depth, layer):
+        raise NotImplementedError("Implement in subclass")
+
+    @staticmethod
+    def sizes(rects, width, depth):
+        """
+        Widths and depths of the rectangles, and (K, 2) arrays of the width and depth of the present
+        in each orientation
+        """
+        rect_widths = (rects[:, 2] - rects[:, 0] + 1)[:, np.newaxis]
+        rect_depths = (rects[:, 3] - rects[:, 1] + 1)[:, np.newaxis]
+        widths = np.array([[width, depth]])
+        depths = np.array([[depth, width]])
+        return rect_widths, rect_depths, widths, depths
+
+
+class BottomLeft(PlacementHeuristic):
+    """
+    Lowest top edge, as in MaxRectsLayer
+    """
+
+    def score(self, rects, width, depth, layer):
+        return rects[:, 1, np.newaxis] + np.array([[depth, width]]) - 1
+
+
+class BestShortSideFit(PlacementHeuristic):
+    """
+    Smallest leftover on the shorter side of the rectangle, then on the longer side
+    """
+
+    def score(self, rects, width, depth, layer):
+        rect_widths, rect_depths, widths, depths = self.sizes(rects, width, depth)
+        leftover_x = rect_widths - widths
+        leftover_y = rect_depths - depths
+        short = np.minimum(leftover_x, leftover_y)
+        long_side = np.maximum(leftover_x, leftover_y)
+        return short * (MAX_X + MAX_Y) + long_side
+
+
+class BestLongSideFit(PlacementHeuristic):
+    """
+    Smallest leftover on the longer side of the rectangle, then on the shorter side
+    """
+
+    def score(self, rects, width, depth, layer):
+        rect_widths, rect_depths, widths, depths = self.sizes(rects, width, depth)
+        leftover_x = rect_widths - widths
+        leftover_y = rect_depths - depths
+        short = np.minimum(leftover_x, leftover_y)
+        long_side = np.maximum(leftover_x, leftover_y)
+        return long_side * (MAX_X + MAX_Y) + short
+
+
+class BestAreaFit(PlacementHeuristic):
+    """
+    Smallest rectangle that fits, then the smallest leftover on the shorter side
+    """
+
+    def score(self, rects, width, depth, layer):
+        rect_widths, rect_depths, widths, depths = self.sizes(rects, width, depth)
+        area_left = rect_widths * rect_depths - width * depth
+        short = np.minimum(rect_widths - widths, rect_depths - depths)
+        return area_left.astype(np.int64) * (MAX_X + MAX_Y) + short
+
+
+class ContactPoint(PlacementHeuristic):
+    """
+    Longest perimeter touching the edges of the layer and the presents already in it
+    """
+
+    def score(self, rects, width, depth, layer):
+        x1 = rects[:, 0, np.newaxis]
+        y1 = rects[:, 1, np.newaxis]
+        x2 = x1 + np.array([[width, depth]]) - 1
+        y2 = y1 + np.array([[depth, width]]) - 1
+
+        # Edges of the layer
+        contact = ((x1 == 1).astype(np.int64) + (x2 == MAX_X)) * (y2 - y1 + 1)
+        contact += ((y1 == 1).astype(np.int64) + (y2 == MAX_Y)) * (x2 - x1 + 1)
+
+        # Edges of the presents in the layer, with a trailing axis over the presents
+        placed = presents_to_boxes(layer.presents.values())
+        if len(placed):
+            px1, py1, px2, py2 = placed[:, 1], placed[:, 2], placed[:, 4], placed[:, 5]
+            x1, y1, x2, y2 = [a[:, :, np.newaxis] for a in (x1, y1, x2, y2)]
+            shared_y = np.maximum(np.minimum(y2, py2) - np.maximum(y1, py1) + 1, 0)
+            shared_x = np.maximum(np.minimum(x2, px2) - np.maximum(x1, px1) + 1, 0)
+            touching_x = (px2 + 1 == x1) | (x2 + 1 == px1)
+            touching_y = (py2 + 1 == y1) | (y2 + 1 == py1)
+            contact += (touching_x * shared_y + touching_y * shared_x).sum(axis=2)
+        return -contact
+
+
+HEURISTICS = {
+    'bottom_left': BottomLeft,
+    'best_short_side_fit': BestShortSideFit,
+    'best_long_side_fit': BestLongSideFit,
+    'best_area_fit': BestAreaFit,
+    'contact_point': ContactPoint,
+}
+
+
+def choose_placement(rects, width, depth, heuristic, layer):
+    """
+    Chooses a free rectangle with a PlacementHeuristic
+    Returns the row of the chosen rectangle and whether the present is rotated, or None if it doesn't fit anywhere.
+
+    Breaks ties in the same way as the loop in MaxRectsLayer, which tries the orientation of the best placement
+    found so far first, and only takes a strictly better placement.  So the earliest rectangle with the best score wins,
+    and if both orientations tie in that rectangle, the orientation of the best earlier rectangle wins.
+    """
+    rects = np.asarray(rects).reshape(-1, 4)
+    rect_widths, rect_depths, widths, depths = PlacementHeuristic.sizes(rects, width, depth)
+    fits = (widths <= rect_widths) & (depths <= rect_depths)
+    scores = np.where(fits, heuristic.score(rects, width, depth, layer), np.inf)
+    as_is, rotated = scores[:, 0], scores[:, 1]
+    best = np.minimum(as_is, rotated)
+
+    chosen = int(np.argmin(best)) if len(best) else 0
+    if not len(best) or best[chosen] == np.inf:
+        return None
+
+    i = chosen
+    while as_is[i] == rotated[i] and i > 0:
+        i = int(np.argmin(best[:i]))
+        if best[i] == np.inf:
+            break
+    return chosen, bool(rotated[i] < as_is[i])
+
+
 class MaxRectsLayer(Layer):
     """
     Layer that places presents based on the MaxRects algorithm
+    Set heuristic to a PlacementHeuristic to choose the free rectangles with it instead of the bottom left rule
     """
+    heuristic = None
 
     def __init__(self):
         super(MaxRectsLayer, self).__init__()
         first_free_rect = Present(-1, 1000, 1000, 0)
-        self._free_rectangles = [first_free_rect]
+        self._free_rectangles = FreeRectangleIndex()
+        self._free_rectangles.append(first_free_rect)
+        self.free_area = MAX_X * MAX_Y
+
+    def free_space(self):
+        rects = self._free_rectangles
+        return self.free_area, rects.max_width, rects.max_depth, rects.max_short_side
 
     def place_present(self, present):
         """
@@ -335,6 +1367,10 @@ class MaxRectsLayer(Layer):
         Prune the list of free rectangles (check if any free rectangles are fully contained by other free rectangles
         """
         logger.debug("Placing present: {}".format(present))
+        # Reject presents that can't fit without scanning the free rectangles
+        if not self.could_fit(present):
+            logger.debug("Present doesn't fit in Layer")
+            return False
         free_rect = self.choose_free_rectangle(present)
         if free_rect is None:
             # Layer is full
@@ -345,83 +1381,58 @@ class MaxRectsLayer(Layer):
         logger.debug("Placing present at {}, {}".format(free_rect.position[0], free_rect.position[1]))
         present.position = free_rect.position
         self.presents[present.position] = present
+        self.free_area -= present.x * present.y
         if present.zmax > self.max_z:
             self.max_z = present.zmax
 
         if present.xmax > MAX_X or present.ymax > MAX_Y:
             logger.warn("Present {} exceeds bounds of layer".format(present.pid))
 
-        # Iterate over the free rectangles to check for splits
-        # Keep only rectangles that do not overlap and new rectangles created from splits
-        new_rectangles = []
-        for i, rect in enumerate(self._free_rectangles):
-            if present.overlaps_xy(rect):
-                new_rectangles += self.split_rectangle(rect, present)
-            else:
-                new_rectangles.append(rect)
+        # Split the free rectangles that the present overlaps
+        # The splits take the place of the rectangle they were split from
+        new_ids = []
+        for rid in self._free_rectangles.overlapping(present):
+            new_ids += self._free_rectangles.replace(rid, self.split_rectangle(self._free_rectangles[rid], present))
 
         # Prune the rectangles
-        self._free_rectangles = self.prune_rectangles(new_rectangles)
+        self.prune_rectangles(new_ids)
         return True
 
     def choose_free_rectangle(self, present):
         """
         Decides which free rectangle to put the present into.  Returns the free rectangle
-        We use the bottom left rule
-        """
-        chosen_rect = None
-        best_y = 1001
-        for rect in self._free_rectangles:
-            # Place as is and see if it'll fit
-            first_y = self.place_present_in_rectangle(present, rect)
-            if first_y is not False and first_y < best_y:
-                best_y = first_y
-                chosen_rect = rect
-
-            # Rotate and place and see if it'll fit
-            present.rotate_xy()
-            second_y = self.place_present_in_rectangle(present, rect)
-            if second_y is not False and second_y < best_y:
-                best_y = second_y
-                chosen_rect = rect
-            else:
-                # Otherwise be sure to rotate the present back
+        We use the bottom left rule, unless there is a heuristic
+        """
+        if self.heuristic is not None:
+            rects = list(self._free_rectangles)
+            boxes = [(r.xmin, r.ymin, r.xmax, r.ymax) for r in rects]
+            chosen = choose_placement(boxes, present.x, present.y, self.heuristic, self)
+            if chosen is None:
+                return None
+            if chosen[1]:
                 present.rotate_xy()
-        return chosen_rect
+            return rects[chosen[0]]
 
-    def place_present_in_rectangle(self, present, rectangle):
-        """
-        Tries to place the present in the rectangle.
-        Returns False if it doesn't fit.  Otherwise returns the new maximum y coordinate
-        """
-        present.position = rectangle.position
-        # Check if it fits
-        if present.ymax > rectangle.ymax or present.xmax > rectangle.xmax:
-            return False
-            # If it does, return the ymax
-        return present.ymax
+        chosen = self._free_rectangles.bottom_left(present.x, present.y)
+        if chosen is None:
+            return None
+        rid, rotated = chosen
+        if rotated:
+            present.rotate_xy()
+        return self._free_rectangles[rid]
 
-    def prune_rectangles(self, rectangles):
+    def prune_rectangles(self, rect_ids):
         """
-        Takes a list of rectangles, and returns a new list, removing rectangles that are fully encompassed by others
+        Removes the free rectangles in rect_ids that are fully encompassed by other free rectangles
+
+        Only rectangles that were just created by splits need to be checked.
+        The remaining rectangles weren't contained in anything before the split,
+        and the splits are smaller than the rectangles they came from, so they can't contain them now.
         """
-        new_rects = []
-        for r1 in rectangles:
-            contained = False
-            for r2 in rectangles:
-                if r1.xmin > r2.xmax or r1.xmax < r2.xmin or r1.ymin > r2.ymax or r1.ymax < r2.ymin:
-                    continue
-                if (r1.x1, r1.y1, r1.x2, r1.y2) == (r2.x1, r2.y1, r2.x2, r2.y2):
-                    continue
-                    # Apparently faster than doing the method call
-                if (r1.xmin >= r2.xmin and r1.ymin >= r2.ymin) and \
-                        (r1.xmax <= r2.xmax and r1.ymax <= r2.ymax):
-                    contained = True
-                    break
-            if not contained:
-                new_rects.append(r1)
-        logger.debug("Pruned {} rectangles".format(len(rectangles) - len(new_rects)))
-        return new_rects
+        contained = [rid for rid in rect_ids if self._free_rectangles.is_contained(rid)]
+        for rid in contained:
+            self._free_rectangles.remove(rid)
+        logger.debug("Pruned {} rectangles".format(len(contained)))
 
     def split_rectangle(self, rectangle, present):
         """
@@ -458,6 +1469,224 @@ class MaxRectsLayer(Layer):
         return new_rects
 
 
+class ArrayMaxRectsLayer(Layer):
+    """
+    MaxRects layer that keeps the free rectangles in a (K, 4) numpy array of x1, y1, x2, y2
+
+    Fit and scoring are computed for all rectangles and both orientations at once,
+    and splitting and pruning are done with array operations.
+    Makes exactly the same placements as MaxRectsLayer, with the same heuristic.
+    """
+    heuristic = BottomLeft()
+
+    def __init__(self):
+        super(ArrayMaxRectsLayer, self).__init__()
+        self._free_rectangles = np.array([[1, 1, MAX_X, MAX_Y]], dtype=np.int32)
+        self.free_area = MAX_X * MAX_Y
+        # Largest width, depth and shortest side of the free rectangles
+        self._max_sides = (MAX_X, MAX_Y, min(MAX_X, MAX_Y))
+
+    def free_space(self):
+        return (self.free_area,) + self._max_sides
+
+    def place_present(self, present):
+        """
+        Same steps as MaxRectsLayer.place_present
+        """
+        logger.debug("Placing present: {}".format(present))
+        # Reject presents that can't fit without scanning the free rectangles
+        if not self.could_fit(present):
+            logger.debug("Present doesn't fit in Layer")
+            return False
+        chosen = self.choose_free_rectangle(present)
+        if chosen is None:
+            # Layer is full
+            logger.debug("Present doesn't fit in Layer")
+            return False
+
+        x1, y1 = self._free_rectangles[chosen, :2].tolist()
+        logger.debug("Placing present at {}, {}".format(x1, y1))
+        present.position = (x1, y1, self.z)
+        self.presents[present.position] = present
+        self.free_area -= present.x * present.y
+        if present.zmax > self.max_z:
+            self.max_z = present.zmax
+
+        if present.xmax > MAX_X or present.ymax > MAX_Y:
+            logger.warn("Present {} exceeds bounds of layer".format(present.pid))
+
+        rectangles, is_new = self.split_rectangles(present)
+        self._free_rectangles = self.prune_rectangles(rectangles, is_new)
+        rects = self._free_rectangles
+        if len(rects):
+            widths = rects[:, 2] - rects[:, 0] + 1
+            depths = rects[:, 3] - rects[:, 1] + 1
+            self._max_sides = (int(widths.max()), int(depths.max()), int(np.minimum(widths, depths).max()))
+        else:
+            self._max_sides = (0, 0, 0)
+        return True
+
+    def choose_free_rectangle(self, present):
+        """
+        Decides which free rectangle to put the present into, using the heuristic.
+        Returns the row of the chosen rectangle, or None if the present doesn't fit anywhere.
+        Rotates the present if the rotated orientation is chosen.
+        """
+        chosen = choose_placement(self._free_rectangles, present.x, present.y, self.heuristic, self)
+        if chosen is None:
+            return None
+        row, rotated = chosen
+        if rotated:
+            present.rotate_xy()
+        return row
+
+    def split_rectangles(self, present):
+        """
+        Splits every free rectangle that overlaps with present into at most four new MaxRects,
+        in the same way as MaxRectsLayer.split_rectangle.
+        Returns the new array of rectangles, with the splits in the place of the rectangle they came from,
+        and a boolean array marking which rectangles are new.
+        """
+        rects = self._free_rectangles
+        x1, y1, x2, y2 = rects.T
+        px1, py1, px2, py2 = present.xmin, present.ymin, present.xmax, present.ymax
+        overlaps = ~((x2 < px1) | (px2 < x1) | (y2 < py1) | (py2 < y1))
+
+        # Candidate splits of each rectangle: left, right, top, bottom
+        splits = np.repeat(rects[:, np.newaxis, :], 4, axis=1)
+        splits[:, 0, 2] = px1 - 1
+        splits[:, 1, 0] = px2 + 1
+        splits[:, 2, 1] = py2 + 1
+        splits[:, 3, 3] = py1 - 1
+        valid = np.empty((len(rects), 4), dtype=bool)
+        valid[:, 0] = (x1 < px1) & (px1 < x2)
+        valid[:, 1] = (x1 < px2) & (px2 < x2)
+        valid[:, 2] = (y1 < py2) & (py2 < y2)
+        valid[:, 3] = (y1 < py1) & (py1 < y2)
+
+        # Rectangles that don't overlap are kept as they are
+        kept = ~overlaps
+        splits[kept, 0] = rects[kept]
+        valid[kept] = False
+        valid[kept, 0] = True
+
+        valid = valid.ravel()
+        is_new = np.repeat(overlaps, 4)[valid]
+        return splits.reshape(-1, 4)[valid], is_new
+
+    def prune_rectangles(self, rectangles, is_new):
+        """
+        Removes the new rectangles that are fully encompassed by another rectangle.
+        See MaxRectsLayer.prune_rectangles for why the old rectangles don't need to be checked.
+        """
+        new = rectangles[is_new]
+        encloses = ((rectangles[:, 0] <= new[:, 0, np.newaxis]) & (rectangles[:, 1] <= new[:, 1, np.newaxis]) &
+                    (rectangles[:, 2] >= new[:, 2, np.newaxis]) & (rectangles[:, 3] >= new[:, 3, np.newaxis]))
+        identical = np.all(rectangles[np.newaxis, :, :] == new[:, np.newaxis, :], axis=2)
+        contained = np.any(encloses & ~identical, axis=1)
+        keep = np.ones(len(rectangles), dtype=bool)
+        keep[np.flatnonzero(is_new)[contained]] = False
+        logger.debug("Pruned {} rectangles".format(np.count_nonzero(contained)))
+        return rectangles[keep]
+
+
+class ResidualSpaceIndex(object):
+    """
+    Empty boxes of space left in closed layers, that later presents can be dropped into
+
+    A gap is an x1, y1, z1, x2, y2, z2 box.  The gaps are kept in buckets by their shortest side,
+    so finding a gap for a present only looks at the buckets with gaps at least as thick as the present,
+    and all of the gaps in a bucket are checked at once.
+    """
+
+    def __init__(self, bucket_size=10):
+        self.bucket_size = bucket_size
+        # Bucket -> [(capacity, 6) array of gaps, number of gaps in use]
+        self._buckets = {}
+
+    def __len__(self):
+        return sum(count for gaps, count in self._buckets.values())
+
+    def clear(self):
+        self._buckets = {}
+
+    def add(self, x1, y1, z1, x2, y2, z2):
+        if x2 < x1 or y2 < y1 or z2 < z1:
+            return
+        shortest = min(x2 - x1, y2 - y1, z2 - z1) + 1
+        bucket = self._buckets.setdefault(shortest // self.bucket_size, [np.empty((16, 6), dtype=np.int64), 0])
+        gaps, count = bucket
+        if count == len(gaps):
+            gaps = bucket[0] = np.concatenate([gaps, np.empty_like(gaps)])
+        gaps[count] = (x1, y1, z1, x2, y2, z2)
+        bucket[1] = count + 1
+
+    def add_below(self, presents, z):
+        """
+        Adds the columns between each of presents and z, e.g. under the presents of a layer aligned to its top
+        """
+        for p in presents:
+            self.add(p.xmin, p.ymin, z, p.xmax, p.ymax, p.zmin - 1)
+
+    def find(self, dimensions, max_top=None):
+        """
+        Finds the smallest gap in the first bucket that has a gap the present fits in, in any orientation
+        Only gaps with a top no higher than max_top are used, if it is given.
+        Returns (bucket, index) of the gap, or None
+        """
+        sides = sorted(dimensions)
+        first = sides[0] // self.bucket_size
+        for key in sorted(k for k in self._buckets if k >= first):
+            gaps, count = self._buckets[key]
+            gaps = gaps[:count]
+            gap_sides = np.sort(gaps[:, 3:] - gaps[:, :3] + 1, axis=1)
+            fits = np.all(gap_sides >= sides, axis=1)
+            if max_top is not None:
+                fits &= gaps[:, 5] <= max_top
+            if fits.any():
+                volumes = np.where(fits, np.prod(gap_sides, axis=1), np.iinfo(np.int64).max)
+                return key, int(np.argmin(volumes))
+        return None
+
+    def remove(self, key, index):
+        """
+        Removes a gap, moving the last gap of the bucket into its place
+        """
+        bucket = self._buckets[key]
+        gaps, count = bucket
+        gap = gaps[index].tolist()
+        gaps[index] = gaps[count - 1]
+        bucket[1] = count - 1
+        if not bucket[1]:
+            del self._buckets[key]
+        return gap
+
+    def place_present(self, present, max_top=None):
+        """
+        Puts the present at the top of the best gap it fits in, and adds the space left around it as new gaps
+        Returns False if it doesn't fit in any of the gaps
+        """
+        found = self.find((present.x, present.y, present.z), max_top)
+        if found is None:
+            return False
+        x1, y1, z1, x2, y2, z2 = self.remove(*found)
+
+        # Longest side of the present along the longest side of the gap, and so on
+        sides = sorted((present.x, present.y, present.z))
+        gap_sides = (x2 - x1 + 1, y2 - y1 + 1, z2 - z1 + 1)
+        dims = [0, 0, 0]
+        for axis, side in zip(sorted(range(3), key=lambda a: gap_sides[a]), sides):
+            dims[axis] = side
+        present.set_dimensions(*dims)
+        present.position = (x1, y1, z2 - dims[2] + 1)
+
+        # Space below the present, and the rest of the gap beside it
+        self.add(x1, y1, z1, present.xmax, present.ymax, present.zmin - 1)
+        self.add(present.xmax + 1, y1, z1, x2, y2, z2)
+        self.add(x1, present.ymax + 1, z1, present.xmax, y2, z2)
+        return True
+
+
 class LayerCursor(object):
     """
     Cursor object for keeping track of where we are in a layer
@@ -504,15 +1733,15 @@ class Sleigh(object):
     def output_presents(self):
         raise NotImplementedError("Implement in subclass")
 
+    def output_boxes(self):
+        """
+        (N, 7) array of pid, x1, y1, z1, x2, y2, z2 of all of the presents in the sleigh
+        """
+        raise NotImplementedError("Implement in subclass")
+
     def write_to_file(self, outfile):
         logger.info("Writing output file")
-        count = 0
-        with open(outfile, 'wb') as out:
-            write = csv.writer(out)
-            write.writerow(create_header())
-            for row in self.output_presents():
-                write.writerow(row)
-                count += 1
+        count = write_submission(outfile, self.output_boxes())
         logger.info("{} presents written to file".format(count))
 
 
@@ -520,6 +1749,8 @@ class LayerSleigh(Sleigh):
     """
     A Sleigh is a collection of Layers
     """
+    # Attributes saved with checkpoints, besides the layers
+    checkpoint_fields = ('max_z', 'n_placed', 'order_term', 'expected_presents')
 
     def __init__(self):
         # Hash of layers
@@ -527,6 +1758,87 @@ class LayerSleigh(Sleigh):
         self.layers = {}
         self.max_z = 1
         self._errors = []
+        # Running totals for the metric, updated as each layer is added
+        self.n_placed = 0
+        self.order_term = 0
+        # Number of presents that will be packed in total.
+        # Needed to rank the presents from the top of the sleigh while packing bottom up
+        self.expected_presents = NUM_PRESENTS
+        self.n_layers = 0
+        # LayerSpill the closed layers go to instead of self.layers, when streaming
+        self.spill = None
+        # SleighCheckpoint that records the layers as they are added
+        self.checkpoint = None
+
+    def stream_to(self, directory=None, run_size=100000):
+        """
+        Writes the layers to temporary files as they are added, instead of keeping them in memory
+        The layers are dropped once they are written, so memory doesn't grow with the number of presents.
+        """
+        self.spill = LayerSpill(directory, run_size)
+
+    def keep_layer(self, layer):
+        """
+        Stores a layer that is in its final position
+        """
+        self.n_layers += 1
+        if self.checkpoint is not None:
+            self.checkpoint.record(layer)
+        if self.spill is None:
+            self.layers[layer.z] = layer
+        else:
+            self.spill.add(presents_to_boxes(layer.presents.values()))
+
+    def count_presents(self):
+        count = sum(l.n_presents for l in self.layers.values())
+        if self.spill is not None:
+            count += self.spill.count
+        return count
+
+    @property
+    def height(self):
+        return self.max_z
+
+    def first_rank(self, layer):
+        """
+        Rank, counting from the top of the sleigh, of the first present in a newly added layer
+        Packing bottom up, the layer is below all of the presents that are still to come
+        """
+        return self.expected_presents - self.n_placed - layer.n_presents + 1
+
+    def update_score(self, layer):
+        """
+        Adds the order term of a newly added layer to the running order term
+        Layers don't overlap, so the presents in the layer rank after all presents in higher layers
+        and before all presents in lower layers.  Within the layer they are ranked by their top, then their id.
+        """
+        presents = layer.presents.values()
+        pids = np.array([p.pid for p in presents], dtype=np.int64)
+        tops = np.array([p.zmax for p in presents], dtype=np.int64)
+        first = self.first_rank(layer)
+        ranks = np.arange(first, first + len(pids))
+        self.order_term += int(np.abs(ranks - pids[np.lexsort((pids, -tops))]).sum())
+        self.n_placed += len(pids)
+
+    def projected_score(self):
+        """
+        Metric extrapolated from the presents placed so far to expected_presents
+        """
+        if not self.n_placed:
+            return None
+        scale = float(self.expected_presents) / self.n_placed
+        return scale * (2 * self.height + self.order_term)
+
+    def score(self):
+        # Use the running totals if all the presents went through add_layer, otherwise score from scratch,
+        # from the boxes of the layers in memory and the spilled ones
+        if self.n_placed == self.expected_presents == self.count_presents():
+            height_term, order_term = self.height, self.order_term
+        else:
+            height_term, order_term = score_boxes(self.output_boxes())
+        metric = 2 * height_term + order_term
+        print '{} = 2 * height term: {} + order term: {}'.format(metric, height_term, order_term)
+        return metric
 
     @staticmethod
     def load_from_file(filename):
@@ -560,9 +1872,10 @@ class LayerSleigh(Sleigh):
 
     def add_layer(self, layer):
         # Add a layer to the layer hash and update the max_z of the Sleigh
-        self.layers[layer.z] = layer
+        self.keep_layer(layer)
         self.max_z = layer.max_z
-        count = len(self.layers)
+        self.update_score(layer)
+        count = self.n_layers
         if (count % 100) == 0:
             logger.info(
                 "Layer # {} with {} presents added to the sleigh. New max z is {}".format(count, layer.n_presents,
@@ -571,7 +1884,7 @@ class LayerSleigh(Sleigh):
     def check_count(self):
         # Check that there are a million presents
         logger.info("Checking that the number of presents is correct")
-        return sum([len(x.presents) for x in self.layers.values()]) == NUM_PRESENTS
+        return self.count_presents() == NUM_PRESENTS
 
     def check_presents(self):
         logger.info("Checking that the presents are the correct dimension and in the sleigh")
@@ -588,41 +1901,33 @@ class LayerSleigh(Sleigh):
             vertices = [p.x1, p.x2, p.y1, p.y2]
             if max(vertices) > MAX_Y or min(vertices) < 1:
                 self._errors.append('Present {} exceeds boundaries of sleigh'.format(p.pid))
+        if self.spill is not None:
+            # Same checks on the boxes of the layers that were written out
+            for pid, x1, y1, z1, x2, y2, z2 in self.spill.boxes().tolist():
+                actual_present = all_presents[pid]
+                dimensions = {x2 - x1 + 1, y2 - y1 + 1, z2 - z1 + 1}
+                if dimensions != actual_present.dimensions:
+                    self._errors.append(
+                        'Present {} has dimensions {}, should be {}'.format(pid, dimensions, actual_present.dimensions))
+                if max(x1, x2, y1, y2) > MAX_Y or min(x1, x2, y1, y2) < 1:
+                    self._errors.append('Present {} exceeds boundaries of sleigh'.format(pid))
         if starting_length < len(self._errors):
             return False
         else:
             return True
 
     def check_collisions(self):
-        # This needs to be improved since it assumes that presents don't exceed the bounds of the Layer
-        # Can use the method in MetricCalculation
+        # Check every present against every other present in the sleigh, not only within layers
         logger.info("Checking for collisions")
-        sorted_layers = sorted(self.layers.values(), key=lambda l: l.z)
-        a, b = itertools.tee(sorted_layers)
-        next(b, None)
-        for l1, l2 in itertools.izip(a, b):
-            # Check that layers are non-overlapping
-            logger.debug("Checking overlap in layers {} and {}".format(l1, l2))
-            if not l1.max_z < l2.z:
-                self._errors.append('Layers at {} and {} overlap'.format(l1.z, l2.z))
-                return False
-                # Check that the boxes in each layer don't overlap
-            if l1.z == 1:
-                # Need to also be sure to check the first layer
-                logger.debug("Checking collisions in layer {}".format(l1))
-                if not l1.check_collisions():
-                    self._errors.append('Overlap in layer at z {}'.format(l1.z))
-                    return False
-            logger.debug("Checking collisions in layer {}".format(l2))
-            if not l2.check_collisions():
-                self._errors.append('Overlap in layer at z {}'.format(l1.z))
-                return False
-
-        return True
+        collisions = find_collisions(self.output_boxes())
+        for pid1, pid2 in collisions.tolist():
+            self._errors.append('Present {} overlaps with present {}'.format(pid1, pid2))
+        if len(collisions):
+            logger.info("Found {} collisions".format(len(collisions)))
+        return len(collisions) == 0
 
     def check_all(self):
-        # Don't check in layer collisions because it's too slow at the moment
-        return self.check_count() and self.check_presents()
+        return self.check_count() and self.check_presents() and self.check_collisions()
 
     def output_presents(self, descending=True):
         """
@@ -634,24 +1939,55 @@ class LayerSleigh(Sleigh):
             vertices = p.vertices
             yield [p.pid] + vertices
 
+    def output_boxes(self):
+        boxes = presents_to_boxes(itertools.chain.from_iterable(l.presents.values() for l in self.layers.values()))
+        if self.spill is not None:
+            boxes = np.concatenate([boxes, self.spill.boxes()])
+        return boxes
+
+    def write_to_file(self, outfile):
+        if self.spill is None or self.layers:
+            return super(LayerSleigh, self).write_to_file(outfile)
+        # All of the layers were written out, so merge the runs instead of loading them all back
+        logger.info("Writing output file")
+        count = write_submission_chunks(outfile, self.spill.merged())
+        logger.info("{} presents written to file".format(count))
+
 
 class ReverseLayerSleigh(LayerSleigh):
     """
     Same as LayerSleigh, but stacks layers into -z axis
     """
+    checkpoint_fields = LayerSleigh.checkpoint_fields + ('min_z',)
 
     def __init__(self):
         super(ReverseLayerSleigh, self).__init__()
         self.min_z = 0
 
-    def add_layer(self, layer):
+    @property
+    def height(self):
+        # The top layer ends at -1, and the sleigh is shifted up to start at 1 once it is packed
+        return -self.min_z
+
+    def first_rank(self, layer):
+        # Packing top down, the layer is below all of the presents placed so far
+        return self.n_placed + 1
+
+    def add_layer(self, layer, placed=()):
+        """
+        placed are presents that are already in their final position, e.g. in gaps of the layer above,
+        and are kept and scored with this layer
+        """
         # The layer currently occupies -1, layer.z
         # Need to push it down
         new_z = self.min_z - layer.height
         layer.reposition_at_z(new_z)
-        self.layers[layer.z] = layer
+        for present in placed:
+            layer.presents[present.position] = present
+        self.keep_layer(layer)
         self.min_z = new_z
-        count = len(self.layers)
+        self.update_score(layer)
+        count = self.n_layers
         if (count % 100) == 0:
             logger.info(
                 "Layer # {} with {} presents added to the sleigh. New min z is {}".format(count, layer.n_presents,
@@ -677,6 +2013,9 @@ class ZMapSleigh(Sleigh):
     The z-map is an 1000 x 1000 numpy array that keeps track of lowest *occupied* z for that space on the x,y plane
     """
 
+    # Find windows with an integral image of the free slots, instead of checking them one at a time
+    use_integral_image = True
+
     def __init__(self):
         self.z_map = np.zeros((MAX_X, MAX_Y), dtype=np.int32)
         self._presents = {}  # Dict of presents, keys are coordinates, values are presents
@@ -684,13 +2023,15 @@ class ZMapSleigh(Sleigh):
         self._errors = []
 
     def check_collisions(self):
-        for p1, p2 in itertools.combinations(self._presents.values(), 2):
-            if p1.overlaps_xy(p2):
-                logger.info('Present {} overlaps with present {}'.format(p1.pid, p2.pid))
-                self._errors.append('Present {} overlaps with present {}'.format(p1.pid, p2.pid))
-                return False
-        return True
+        logger.info("Checking for collisions")
+        collisions = find_collisions(presents_to_boxes(self._presents.values()))
+        for pid1, pid2 in collisions.tolist():
+            logger.info('Present {} overlaps with present {}'.format(pid1, pid2))
+            self._errors.append('Present {} overlaps with present {}'.format(pid1, pid2))
+        return len(collisions) == 0
 
+    def check_all(self):
+        return self.check_collisions()
 
     def output_presents(self, descending=True):
         all_presents = sorted(self._presents.values(), key=lambda x: x.pid, reverse=descending)
@@ -698,6 +2039,9 @@ class ZMapSleigh(Sleigh):
             vertices = p.vertices
             yield [p.pid] + vertices
 
+    def output_boxes(self):
+        return presents_to_boxes(self._presents.values())
+
     def search_position_bottom_left(self, present, available_slots):
         """
         Search for available slots from the bottom left of the slice
@@ -717,6 +2061,24 @@ class ZMapSleigh(Sleigh):
                     return i, j
         return False
 
+    def search_position_integral(self, present, available_slots):
+        """
+        Same search as search_position_bottom_left, but checks all windows at once.
+        Builds the summed-area table of available_slots, so the number of free slots in every window
+        is four lookups.  A window fits if all of its slots are free.
+        """
+        rows, cols = present.y, present.x
+        sat = np.zeros((available_slots.shape[0] + 1, available_slots.shape[1] + 1), dtype=np.int32)
+        np.cumsum(np.cumsum(available_slots, axis=0, dtype=np.int32), axis=1, out=sat[1:, 1:])
+        window_sums = sat[rows:, cols:] - sat[:-rows, cols:] - sat[rows:, :-cols] + sat[:-rows, :-cols]
+        # Flip the rows, so that argmax finds the bottom-most row first, then the left-most column
+        fits = (window_sums == rows * cols)[::-1]
+        k = np.argmax(fits)
+        i, j = np.unravel_index(k, fits.shape)
+        if not fits[i, j]:
+            return False
+        return fits.shape[0] - 1 - i, j
+
     def place_present(self, present):
         # Decide which corner to start searching from
         # Decide how to rotate the package -- which dimension should be shortest?
@@ -734,7 +2096,10 @@ class ZMapSleigh(Sleigh):
             if np.sum(available_slots) < present_area:
                 continue
             # Start search from the bottom left
-            np_position = self.search_position_bottom_left(present, available_slots)
+            if self.use_integral_image:
+                np_position = self.search_position_integral(present, available_slots)
+            else:
+                np_position = self.search_position_bottom_left(present, available_slots)
             if np_position is False:
                 # Returns false if it doesn't fit into a continuous window
                 continue
@@ -743,21 +2108,116 @@ class ZMapSleigh(Sleigh):
                 # Need to shift the position + 1 because numpy arrays are 0-indexed
                 # Also need to take into account that the np_position is based on top left corner
                 z_pos = z - present.z
-                position = (np_position[1] + 1, 1000 - np_position[0] + present.y - 1, z_pos)
+                position = (np_position[1] + 1, MAX_Y - np_position[0] - present.y + 1, z_pos)
                 present.position = position
                 self._presents[present.position] = present
                 # Update the z-map
                 self.z_map[np_position[0]:np_position[0] + present.y, np_position[1]:np_position[1] + present.x] = z_pos
                 # We also have to make sure that later presents are not placed higher than this
-                import ipdb; ipdb.set_trace()
                 lower_slots = self.z_map > z
                 if np.any(lower_slots):
                     self.z_map[lower_slots] = z
                 break
         return present.position
 
+    @property
+    def min_z(self):
+        return np.min(self.z_map)
+
     def reverse(self):
         """
         Reverses from -z to positive z axis.  Basically shifts everything upwards by the total height of the sleigh
         """
-        pass
\ No newline at end of file
+        if not self._presents:
+            return
+        diff = 1 - min(p.zmin for p in self._presents.values())
+        presents = self._presents.values()
+        self._presents.clear()
+        for present in presents:
+            present.position = (present.x1, present.y1, present.z1 + diff)
+            self._presents[present.position] = present
+
+
+class SkylineZMapSleigh(ZMapSleigh):
+    """
+    ZMapSleigh that keeps track of the z-map as a skyline instead of a 1000 x 1000 array
+
+    Because later presents can't be placed above earlier ones, the z-map is capped at the top of the last placed
+    present.  Below the cap, the z-map is made up of contours, one for each placed present whose bottom is
+    still under the cap.  Those presents are kept as obstacles in an (M, 5) array of x1, y1, x2, y2, bottom z.
+    A present placed at level z has its top at z - 1, and can only overlap obstacles with bottom z >= z.
+    Candidate positions are only generated at the corners of the obstacles, instead of scanning every window.
+    """
+
+    def __init__(self):
+        self._cap = 0
+        self._obstacles = np.empty((0, 5), dtype=np.int32)
+        self._presents = {}
+        self._genome = []
+        self._errors = []
+
+    @property
+    def z_map(self):
+        """
+        The z-map as an array, for inspection.  Indexed by [y - 1, x - 1]
+        """
+        z_map = np.empty((MAX_Y, MAX_X), dtype=np.int32)
+        z_map.fill(self._cap)
+        for x1, y1, x2, y2, bottom in self._obstacles.tolist():
+            window = z_map[y1 - 1:y2, x1 - 1:x2]
+            np.minimum(window, bottom, out=window)
+        return z_map
+
+    @property
+    def min_z(self):
+        if len(self._obstacles):
+            return min(self._cap, int(self._obstacles[:, 4].min()))
+        return self._cap
+
+    def find_position(self, width, depth, obstacles):
+        """
+        Finds the bottom left position on the x,y plane where a width x depth rectangle doesn't overlap obstacles
+        Returns (x, y), or None if it doesn't fit
+        """
+        # The lowest position either sits on the floor of the sleigh or on the top edge of an obstacle
+        ys = np.unique(np.append(obstacles[:, 3] + 1, 1))
+        ys = ys[ys + depth - 1 <= MAX_Y]
+        for y in ys.tolist():
+            # Obstacles in the band of rows the rectangle would cover, sorted from left to right
+            band = obstacles[(obstacles[:, 1] <= y + depth - 1) & (obstacles[:, 3] >= y)]
+            band = band[np.argsort(band[:, 0], kind='mergesort')]
+            # The gap in front of each obstacle starts right after the furthest right edge so far
+            gap_starts = np.append(1, np.maximum.accumulate(band[:, 2]) + 1)
+            gap_ends = np.append(band[:, 0], MAX_X + 1)
+            fits = np.flatnonzero(gap_ends - gap_starts >= width)
+            if len(fits):
+                return int(gap_starts[fits[0]]), y
+        return None
+
+    def place_present(self, present):
+        # The z levels are the cap and the bottoms of the obstacles.  At the lowest level nothing is in the way.
+        # If the present fits at a level it also fits at every lower level, so binary search for the highest one
+        levels = np.unique(np.append(self._obstacles[:, 4], self._cap))[::-1]
+        positions = {len(levels) - 1: (1, 1)}
+        lo, hi = 0, len(levels) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            position = self.find_position(present.x, present.y, self._obstacles[self._obstacles[:, 4] < levels[mid]])
+            if position is None:
+                lo = mid + 1
+            else:
+                hi = mid
+                positions[mid] = position
+        z = int(levels[lo])
+        position = positions[lo]
+
+        present.position = (position[0], position[1], z - present.z)
+        self._presents[present.position] = present
+
+        # Later presents can't be placed above this one, so lower the cap
+        # and drop the obstacles that are no longer under it
+        self._cap = z
+        obstacles = self._obstacles[self._obstacles[:, 4] < z]
+        self._obstacles = np.vstack([obstacles, [[present.xmin, present.ymin, present.xmax, present.ymax,
+                                                  present.zmin]]]).astype(np.int32)
+        return present.position
\ No newline at end of file
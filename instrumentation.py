@@ -0,0 +1,106 @@
+"""
+Call counts and timers on the hot paths of the packings
+
+    import instrumentation
+    instrumentation.enable()
+    run.TopDownMaxRect().run()
+    print instrumentation.summary()
+    instrumentation.dump('stats.json')
+
+The methods in HOT_PATHS are only wrapped while instrumentation is enabled, so it costs nothing when it is off.
+Times include the time spent in other instrumented methods called from a method.
+Calls made in worker processes, e.g. by TopDownLayerPacking.run_parallel, aren't counted.
+"""
+import functools
+import json
+import time
+import classes
+
+# Class or module, and the names of the methods or functions in it to instrument
+HOT_PATHS = [
+    (classes, ['load_presents', 'write_submission_chunks']),
+    (classes.Layer, ['place_present', 'flip_layer']),
+    (classes.MaxRectsLayer, ['place_present', 'choose_free_rectangle', 'split_rectangle', 'prune_rectangles']),
+    (classes.ArrayMaxRectsLayer, ['place_present', 'choose_free_rectangle', 'split_rectangles', 'prune_rectangles']),
+    (classes.LayerSleigh, ['add_layer']),
+    (classes.ReverseLayerSleigh, ['add_layer']),
+    (classes.SkylineZMapSleigh, ['place_present']),
+]
+
+counts = {}
+seconds = {}
+# (owner, name, original) of the wrapped methods, to put back when disabled
+_originals = []
+
+
+def _timed(label, func):
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            counts[label] = counts.get(label, 0) + 1
+            seconds[label] = seconds.get(label, 0.0) + time.time() - start
+    return timed
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def enable(reset=True):
+    """
+    Starts counting and timing the calls in HOT_PATHS
+    """
+    if reset:
+        counts.clear()
+        seconds.clear()
+    if is_enabled():
+        return
+    for owner, names in HOT_PATHS:
+        for name in names:
+            # Only wrap methods the class defines itself, inherited ones are wrapped on the parent
+            if isinstance(owner, type) and name not in owner.__dict__:
+                continue
+            original = getattr(owner, name)
+            if isinstance(owner, type):
+                original = owner.__dict__[name]
+                label = '{}.{}'.format(owner.__name__, name)
+            else:
+                label = name
+            setattr(owner, name, _timed(label, original))
+            _originals.append((owner, name, original))
+
+
+def disable():
+    """
+    Puts the original methods back.  The counts are kept until the next enable
+    """
+    while _originals:
+        owner, name, original = _originals.pop()
+        setattr(owner, name, original)
+
+
+def report():
+    """
+    Dictionary of label to calls, total seconds and microseconds per call
+    """
+    return dict((label, {
+        'calls': counts[label],
+        'seconds': seconds[label],
+        'us_per_call': 1e6 * seconds[label] / counts[label],
+    }) for label in counts)
+
+
+def summary():
+    """
+    One line with the calls and time of each label, slowest first
+    """
+    labels = sorted(counts, key=lambda label: seconds[label], reverse=True)
+    return '; '.join('{}: {} calls, {:.2f} s'.format(label, counts[label], seconds[label]) for label in labels)
+
+
+def dump(filename):
+    with open(filename, 'wb') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
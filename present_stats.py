@@ -0,0 +1,136 @@
+"""
+Statistics of the presents, computed once and cached next to the presents cache
+
+    stats = PresentStats.from_csv('data/presents.csv')
+    stats.total('volume', 0, 1000)        # volume of the first 1000 presents
+    stats.fit_count(5000, 1000 * 1000)    # how many presents from row 5000 on could share a layer
+    stats.bucket_sums('max_area', 100000) # footprint lying flat of each 100000 presents
+
+The prefix sums are over the rows in the order they are read, so any run of presents is summed in O(1).
+The footprints don't depend on how the presents are rotated about z:
+    min_area: the two shortest sides, the smallest footprint a present can have
+    max_area: the two longest sides, the footprint of a present lying flat, as after rotate_shortest_z
+"""
+import os
+import numpy as np
+from classes import MAX_X, MAX_Y, load_presents, presents_cache_path, presents_cache_key, logger
+
+PREFIX_SUMS = ('min_area', 'max_area', 'volume')
+
+
+def stats_cache_path(presents_file):
+    return presents_cache_path(presents_file) + '.stats.npz'
+
+
+class PresentStats(object):
+    """
+    Prefix sums of the footprints and volumes of the presents, and histograms of their sides
+    """
+
+    def __init__(self, prefix_sums, histograms):
+        """
+        prefix_sums is a dict of name in PREFIX_SUMS to an (N + 1,) int64 array, starting at 0
+        histograms is a (3, max side + 1) array of the number of presents with each length of shortest,
+        middle and longest side
+        """
+        self.prefix_sums = prefix_sums
+        self.histograms = histograms
+
+    @classmethod
+    def from_presents(cls, presents):
+        """
+        Computes the statistics of an (N, 4) array of pid, dim1, dim2, dim3
+        """
+        sides = np.sort(np.asarray(presents)[:, 1:].astype(np.int64), axis=1)
+        values = {
+            'min_area': sides[:, 0] * sides[:, 1],
+            'max_area': sides[:, 1] * sides[:, 2],
+            'volume': sides[:, 0] * sides[:, 1] * sides[:, 2],
+        }
+        prefix_sums = dict((name, np.concatenate([[0], np.cumsum(values[name])])) for name in PREFIX_SUMS)
+        max_side = int(sides.max()) if len(sides) else 0
+        histograms = np.array([np.bincount(sides[:, i], minlength=max_side + 1) for i in xrange(3)])
+        return cls(prefix_sums, histograms)
+
+    @classmethod
+    def from_csv(cls, presents_file, reverse=False):
+        """
+        Statistics of a presents csv file, read back to front if reverse is True
+
+        The statistics of the file read front to back are cached in an .npz file next to the presents cache,
+        with the same key, so they are only computed again when the csv changes.
+        """
+        presents = load_presents(presents_file)
+        cache_file = stats_cache_path(presents_file)
+        key = presents_cache_key(presents_file)
+        stats = None
+        if os.path.exists(cache_file):
+            # Reading an array from the NpzFile copies it out, so the file can be closed
+            with np.load(cache_file) as cached:
+                if str(cached['key']) == key:
+                    stats = cls(dict((name, cached[name]) for name in PREFIX_SUMS), cached['histograms'])
+
+        if stats is None:
+            logger.info('Computing statistics of {}'.format(presents_file))
+            stats = cls.from_presents(presents)
+            # Write to a temporary file first, so an interrupted write never leaves a corrupt cache behind
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, key=np.array(key), histograms=stats.histograms, **stats.prefix_sums)
+            os.rename(tmp_file, cache_file)
+
+        if reverse:
+            stats = stats.reversed()
+        return stats
+
+    def __len__(self):
+        return len(self.prefix_sums['volume']) - 1
+
+    def reversed(self):
+        """
+        Statistics of the same presents read back to front
+        """
+        prefix_sums = dict((name, prefix[-1] - prefix[::-1]) for name, prefix in self.prefix_sums.items())
+        return PresentStats(prefix_sums, self.histograms)
+
+    def sliced(self, start, end):
+        """
+        Statistics of the presents in rows start to end, as if they were the only ones.  The histograms are kept
+        """
+        prefix_sums = dict((name, prefix[start:end + 1] - prefix[start]) for name, prefix in self.prefix_sums.items())
+        return PresentStats(prefix_sums, self.histograms)
+
+    def total(self, name, start, end):
+        """
+        Sum of name over the presents in rows start to end
+        """
+        prefix = self.prefix_sums[name]
+        return int(prefix[end] - prefix[start])
+
+    def fit_count(self, start, area=MAX_X * MAX_Y, name='min_area'):
+        """
+        Number of presents from row start on whose footprints add up to no more than area
+        With the default min_area, no more presents than this can fit in a layer of that area
+        """
+        prefix = self.prefix_sums[name]
+        return int(np.searchsorted(prefix, prefix[start] + area, side='right')) - 1 - start
+
+    def could_fit(self, start, end, area=MAX_X * MAX_Y):
+        """
+        False if the presents in rows start to end can't all fit in a layer of that area, whichever way they are rotated
+        """
+        return self.total('min_area', start, end) <= area
+
+    def bucket_sums(self, name, size):
+        """
+        Sum of name over each run of size presents
+        """
+        prefix = self.prefix_sums[name]
+        edges = np.append(np.arange(0, len(self), size), len(self))
+        return prefix[edges[1:]] - prefix[edges[:-1]]
+
+    def side_counts(self, side, length):
+        """
+        Number of presents whose shortest (side 0), middle (1) or longest (2) side is no longer than length
+        """
+        return int(self.histograms[side, :length + 1].sum())
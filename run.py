@@ -1,9 +1,15 @@
 """
 Packing algorithms
 """
+import copy
 import csv
+import json
 import os
+import multiprocessing
 import classes
+import instrumentation
+import present_stats
+import shared_presents
 from classes import create_header, logger
 import numpy as np
 
@@ -100,9 +106,43 @@ class Packing(object):
     sleigh_class = classes.LayerSleigh
     infile = 'presents_revorder.csv'
     outfile = 'foo.csv'
+    # Read infile back to front, e.g. presents.csv instead of presents_revorder.csv
+    reverse = False
+    # Count and time the hot paths, see instrumentation
+    instrument = False
+    # Whether the packing can pack its layers in a pool of processes with run_parallel.  Check before calling it
+    parallel = False
+    # Whether a run that stopped can be carried on with resume.  Check before calling it
+    resumable = False
 
     def __init__(self):
         self.sleigh = self.sleigh_class()
+        # PresentTable of the presents being packed, loaded in run()
+        self.presents = None
+        # present_stats.PresentStats of the presents, in the same order
+        self.present_stats = None
+        # Set when a run stops early, e.g. because of max_projected_score
+        self.aborted = False
+        # instrumentation.report() of the last instrumented run
+        self._instrument_report = {}
+        self._instrumenting = False
+
+    def load_presents(self):
+        """
+        PresentTable of infile, from shared memory if the file was published with shared_presents
+        """
+        presents_file = os.path.join('data', self.infile)
+        dimensions = shared_presents.attach(presents_file, reverse=self.reverse)
+        if dimensions is not None:
+            return classes.PresentTable(dimensions)
+        return classes.PresentTable.from_csv(presents_file, reverse=self.reverse)
+
+    def resume(self, check=True, write=True):
+        """
+        Carries on a run that stopped, from the last checkpoint, to the same result as a run that didn't stop
+        Subclasses that can save checkpoints implement it and set resumable.
+        """
+        raise ValueError("{} can't be resumed".format(type(self).__name__))
 
     def check(self):
         if not self.sleigh.check_all():
@@ -114,29 +154,132 @@ class Packing(object):
     def score(self):
         return self.sleigh.score()
 
+    def start_instrumentation(self):
+        """
+        Starts counting from zero, when instrument is set.  Call stop_instrumentation in a finally when the run ends
+        """
+        if self.instrument:
+            instrumentation.enable(reset=True)
+            self._instrument_report = {}
+            self._instrumenting = True
+
+    def stop_instrumentation(self):
+        """
+        Keeps the counts of this run and puts the original methods back, so later runs aren't slowed down
+        """
+        if self._instrumenting:
+            self._instrument_report = instrumentation.report()
+            self._instrumenting = False
+            instrumentation.disable()
+
+    def stats(self):
+        """
+        Calls and time spent in the hot paths by this packing, so far in the current run or in the last one,
+        when instrument is set
+        """
+        if self._instrumenting:
+            return instrumentation.report()
+        return dict(self._instrument_report)
+
+    def log_stats(self):
+        if self._instrumenting:
+            logger.info(instrumentation.summary())
+
+    def write_stats(self, filename):
+        with open(filename, 'wb') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
+
 
 class LayerPacking(Packing):
     layer_class = classes.Layer
     log_at = 100000
-
-    def run(self, check=True, write=True):
-        layer = self.layer_class()
-
+    # Stop the run if the projected score goes over this
+    max_projected_score = None
+    # Write closed layers to temporary files in spill_dir instead of keeping them in memory
+    stream = False
+    spill_dir = None
+    # Save a checkpoint to checkpoint_dir every checkpoint_every layers, so that the run can be resumed
+    checkpoint_dir = None
+    checkpoint_every = 100
+    resumable = True
+
+    def load(self):
+        if self.stream:
+            self.sleigh.stream_to(self.spill_dir)
         presents_file = os.path.join('data', self.infile)
-        outfile = os.path.join('data', self.outfile)
-        logger.info("Reading and placing presents")
-        counter = 0
-        with open(presents_file, 'rb') as presents:
-            presents.readline()  # skip header
-            read = csv.reader(presents)
-            for row in read:
-                present = classes.Present(*row)
-                layer = self.process_present(present, layer)
-                counter += 1
-                if counter % self.log_at == 0:
-                    logger.info("Placed {} presents".format(counter))
+        self.presents = self.load_presents()
+        self.present_stats = present_stats.PresentStats.from_csv(presents_file, reverse=self.reverse)
+        self.sleigh.expected_presents = len(self.presents)
+        self.aborted = False
 
-            self.process_last_layer(layer)
+    def run(self, check=True, write=True):
+        self.start_instrumentation()
+        try:
+            self.load()
+            if self.checkpoint_dir is not None:
+                self.sleigh.checkpoint = classes.SleighCheckpoint(self.checkpoint_dir)
+                self.sleigh.checkpoint.clear()
+            return self.place_presents(0, check, write)
+        finally:
+            self.stop_instrumentation()
+
+    def resume(self, check=True, write=True):
+        """
+        Carries on a run that stopped, from the last checkpoint in checkpoint_dir
+        """
+        if not self.resumable:
+            raise ValueError("{} can't be resumed".format(type(self).__name__))
+        self.start_instrumentation()
+        try:
+            self.load()
+            checkpoint = classes.SleighCheckpoint(self.checkpoint_dir)
+            state = checkpoint.restore(self.sleigh, self.presents)
+            self.sleigh.checkpoint = checkpoint
+            return self.place_presents(state['start'], check, write)
+        finally:
+            self.stop_instrumentation()
+
+    def save_checkpoint(self, start):
+        """
+        Saves a checkpoint if checkpoint_every more layers have been closed
+        start is the row of the first present of the open layer.  Layers only depend on the present they start with,
+        so packing again from start gives back the open layer, without having to save it.
+        """
+        checkpoint = self.sleigh.checkpoint
+        if checkpoint is not None and self.sleigh.n_layers % self.checkpoint_every == 0:
+            checkpoint.save(self.sleigh, start=start)
+
+    def open_layer(self):
+        """
+        Layer to start placing presents in, after the layers already in the sleigh
+        """
+        if self.sleigh.n_layers:
+            return classes.Layer(z=self.sleigh.max_z + 1)
+        return self.layer_class()
+
+    def place_presents(self, start, check, write):
+        layer = self.open_layer()
+        self.layer_start = start
+        n_layers = self.sleigh.n_layers
+        logger.info("Placing presents")
+        for row in xrange(start, len(self.presents)):
+            layer = self.process_present(self.presents.view(row), layer)
+            if self.sleigh.n_layers != n_layers:
+                # This present started a new layer
+                n_layers = self.sleigh.n_layers
+                self.layer_start = row
+                self.save_checkpoint(row)
+            counter = row + 1
+            if counter % self.log_at == 0:
+                projected = self.sleigh.projected_score()
+                logger.info("Placed {} presents. Projected score is {}".format(counter, projected))
+                self.log_stats()
+                if self.max_projected_score is not None and projected > self.max_projected_score:
+                    logger.warn("Projected score is over {}, stopping".format(self.max_projected_score))
+                    self.aborted = True
+                    return self
+
+        self.process_last_layer(layer)
 
         logger.info("Finished placing presents")
 
@@ -147,12 +290,19 @@ class LayerPacking(Packing):
             self.check()
         return self
 
+    def layer_is_full(self, present):
+        """
+        True if the presents from the first one in the open layer up to present can't all fit in a layer by area,
+        so trying to place present is bound to fail.  Only known when the statistics are loaded
+        """
+        return self.present_stats is not None and not self.present_stats.could_fit(self.layer_start, present.row + 1)
+
     def process_last_layer(self, layer):
         align_presents_to_layer_top(layer)
         self.sleigh.add_layer(layer)
 
     def process_present(self, present, layer):
-        if not layer.place_present(present):
+        if self.layer_is_full(present) or not layer.place_present(present):
             align_presents_to_layer_top(layer)
             self.sleigh.add_layer(layer)
             layer = classes.Layer(z=self.sleigh.max_z + 1)
@@ -165,9 +315,10 @@ class TopDownLayerPacking(LayerPacking):
     layer_class = classes.Layer
     infile = 'presents.csv'
     outfile = 'sub_topdown_2.csv'
+    parallel = True
 
     def process_present(self, present, layer):
-        if not layer.place_present(present):
+        if self.layer_is_full(present) or not layer.place_present(present):
             # Flip the layer
             layer.flip_layer()
             self.sleigh.add_layer(layer)
@@ -178,8 +329,113 @@ class TopDownLayerPacking(LayerPacking):
     def process_last_layer(self, layer):
         layer.flip_layer()
         self.sleigh.add_layer(layer)
+        self.shift_to_positive_z()
+
+    def open_layer(self):
+        # Layers are packed at the top and pushed down when they are added
+        return self.layer_class()
+
+    def run_parallel(self, processes=None, chunk_size=20000, check=True, write=True):
+        """
+        Same result as run, but packs the layers in a pool of processes
+
+        The presents are split into chunks, and each chunk is packed into layers on its own, as if a new layer
+        started at the first present of the chunk.  A layer only depends on the present it starts with,
+        so a layer from a chunk is exactly the layer the sequential run would make, if the sequential run starts
+        a layer at the same present.  The layers are stitched together in order.  Where the sequential run
+        starts a layer that no chunk started, that layer is re-packed here, until it lines up with the chunk again.
+        Only for packings with parallel set.
+        """
+        if not self.parallel:
+            raise ValueError("{} can't be packed in parallel".format(type(self).__name__))
+        self.start_instrumentation()
+        try:
+            presents_file = os.path.join('data', self.infile)
+            # The workers read their chunks from the shared table, instead of being sent a copy of each chunk
+            with shared_presents.published_files([presents_file]):
+                self.pack_chunks(presents_file, processes, chunk_size)
+            self.shift_to_positive_z()
+
+            if write:
+                self.write()
+
+            if check:
+                self.check()
+            return self
+        finally:
+            self.stop_instrumentation()
+
+    def pack_chunks(self, presents_file, processes, chunk_size):
+        """
+        Packs the chunks of presents_file in the pool, and stitches their layers into the sleigh
+        """
+        self.presents = self.load_presents()
+        self.present_stats = present_stats.PresentStats.from_csv(presents_file, reverse=self.reverse)
+        n = len(self.presents)
+        self.sleigh.expected_presents = n
+        if self.stream:
+            self.sleigh.stream_to(self.spill_dir)
+
+        starts = range(0, n, chunk_size)
+        tasks = [(presents_file, self.reverse, start, min(start + chunk_size, n), None, start + chunk_size >= n)
+                 for start in starts]
+        logger.info("Packing {} chunks of {} presents".format(len(tasks), chunk_size))
+        # The workers pack with a copy of this packing, so settings made on the instance, e.g. layer_class, carry over
+        pool = multiprocessing.Pool(processes, initializer=_install_worker,
+                                    initargs=(self, shared_presents.published()))
+        try:
+            chunk_layers = pool.map(_pack_layers, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info("Stitching layers")
+        next_start = 0
+        repacked = 0
+        for chunk_start, layers in zip(starts, chunk_layers):
+            layers_by_start = dict((layer[0], layer) for layer in layers)
+            while next_start < min(chunk_start + chunk_size, n):
+                layer = layers_by_start.get(next_start)
+                if layer is None:
+                    layer = self.pack_layer_at(presents_file, next_start, chunk_size)
+                    repacked += 1
+                self.add_packed_layer(layer)
+                next_start = layer[1]
+            logger.info("Placed {} presents. Projected score is {}".format(next_start, self.sleigh.projected_score()))
+            self.log_stats()
+        logger.info("Finished placing presents, {} layers re-packed at chunk boundaries".format(repacked))
+
+    def pack_layer_at(self, presents_file, start, window):
+        """
+        Packs the one layer that starts with present start, in this process
+        """
+        n = len(self.presents)
+        while True:
+            final = start + window >= n
+            layers = _pack_layers((presents_file, self.reverse, start, min(start + window, n), 1, final), self)
+            if layers:
+                return layers[0]
+            window *= 2
+
+    def add_packed_layer(self, packed_layer):
+        """
+        Puts a layer packed by _pack_layers into the sleigh
+        """
+        start, end, z, max_z, placements = packed_layer
+        rows = placements[:, 0]
+        self.presents.set_placements(rows, placements[:, 1:4], placements[:, 4:7])
+        layer = classes.Layer(z=z)
+        layer.max_z = max_z
+        for row in rows.tolist():
+            present = self.presents.view(row)
+            layer.presents[present.position] = present
+        self.sleigh.add_layer(layer)
+
+    def shift_to_positive_z(self):
         # Now need to shift everything up
         diff = -1 * (self.sleigh.min_z - 1)
+        if self.sleigh.spill is not None:
+            self.sleigh.spill.z_shift += diff
         layers = self.sleigh.layers.items()
         self.sleigh.layers.clear()
         for z, layer in layers:
@@ -187,6 +443,79 @@ class TopDownLayerPacking(LayerPacking):
             self.sleigh.layers[layer.z] = layer
 
 
+class _LayerRecorder(object):
+    """
+    Stands in for the sleigh in _pack_layers, and keeps the closed layers in a compact form
+    """
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.layers = []
+
+    def add_layer(self, layer):
+        placements = np.array([(p.row + self.offset, p.x, p.y, p.z) + p.position for p in layer.presents.values()],
+                              dtype=np.int32)
+        start = int(placements[:, 0].min())
+        end = int(placements[:, 0].max()) + 1
+        self.layers.append((start, end, layer.z, layer.max_z, placements))
+
+
+# The packing the worker processes of TopDownLayerPacking.run_parallel pack with, set by _install_worker
+_worker_packing = None
+
+
+def _install_worker(packing, tables):
+    """
+    Pool initializer of TopDownLayerPacking.run_parallel
+    The pool forks, so the packing is inherited as it is, and doesn't need to be picklable.
+    """
+    global _worker_packing
+    _worker_packing = packing
+    shared_presents.install(tables)
+
+
+def _pack_layers(args, packing=None):
+    """
+    Packs presents into layers with a copy of a TopDownLayerPacking, starting a new layer at the first present
+    Used by TopDownLayerPacking.run_parallel, so it needs to be picklable.  packing defaults to the one installed
+    in the worker by _install_worker
+
+    args is a tuple of:
+        presents_file: presents file published with shared_presents
+        reverse: if True, the presents file is read back to front
+        start, end: rows of the presents to pack
+        max_layers: stop after this many layers are closed, or None
+        final: if True, the presents run to the end of the file, so the last layer is closed as well
+    Returns a list of the closed layers, as tuples of the first row, the row after the last,
+    layer z, layer max z, and an array of row, x, y, z, x1, y1, z1 of the flipped presents in the layer
+    """
+    presents_file, reverse, start, end, max_layers, final = args
+    dimensions = shared_presents.attach(presents_file, reverse)
+    if dimensions is None:
+        raise ValueError("{} isn't published with shared_presents, or changed since".format(presents_file))
+    packing = copy.copy(packing if packing is not None else _worker_packing)
+    packing.sleigh = _LayerRecorder(start)
+    packing.presents = classes.PresentTable(dimensions[start:end])
+    # The rows of the chunk start from 0, so the statistics are sliced to match
+    if packing.present_stats is not None:
+        packing.present_stats = packing.present_stats.sliced(start, end)
+    packing.layer_start = 0
+    layer = packing.layer_class()
+    for present in packing.presents:
+        n_layers = len(packing.sleigh.layers)
+        layer = packing.process_present(present, layer)
+        if len(packing.sleigh.layers) != n_layers:
+            # This present started a new layer
+            packing.layer_start = present.row
+        if max_layers is not None and len(packing.sleigh.layers) >= max_layers:
+            break
+    else:
+        if final:
+            layer.flip_layer()
+            packing.sleigh.add_layer(layer)
+    return packing.sleigh.layers
+
+
 class TopDownPackingRotateZ(TopDownLayerPacking):
     sleigh_class = classes.ReverseLayerSleigh
     layer_class = classes.Layer
@@ -196,7 +525,7 @@ class TopDownPackingRotateZ(TopDownLayerPacking):
     def process_present(self, present, layer):
         # Rotate the present so that it's z is smallest
         present.rotate_shortest_z()
-        if not layer.place_present(present):
+        if self.layer_is_full(present) or not layer.place_present(present):
             # Flip the layer
             layer.flip_layer()
             self.sleigh.add_layer(layer)
@@ -207,6 +536,7 @@ class TopDownPackingRotateZ(TopDownLayerPacking):
 
 class TopDownMaxRect(TopDownLayerPacking):
     # Needs about 3G of ram because all of the MaxRects are not destroyed when the layer is added to the sleigh
+    # Set stream to write the closed layers out and drop them instead
     sleigh_class = classes.ReverseLayerSleigh
     layer_class = classes.MaxRectsLayer
     infile = 'presents.csv'
@@ -214,6 +544,14 @@ class TopDownMaxRect(TopDownLayerPacking):
     log_at = 10000
 
 
+class TopDownArrayMaxRect(TopDownMaxRect):
+    """
+    TopDownMaxRect, using the numpy implementation of the MaxRects layer
+    """
+    layer_class = classes.ArrayMaxRectsLayer
+    outfile = 'sub_topdown_3_array.csv'
+
+
 class TopDownMaxRectShortestZ(TopDownLayerPacking):
     """
     TopDownMaxRect, but ensuring that the shortest dimension is the z-dimension before placing into the layer
@@ -227,7 +565,7 @@ class TopDownMaxRectShortestZ(TopDownLayerPacking):
     def process_present(self, present, layer):
         # Rotate the present so that it's z is smallest
         present.rotate_shortest_z()
-        if not layer.place_present(present):
+        if self.layer_is_full(present) or not layer.place_present(present):
             # Flip the layer
             layer.flip_layer()
             self.sleigh.add_layer(layer)
@@ -236,34 +574,218 @@ class TopDownMaxRectShortestZ(TopDownLayerPacking):
         return layer
 
 
+class TopDownGapFilling(TopDownMaxRectShortestZ):
+    """
+    TopDownMaxRectShortestZ, also dropping presents into the empty columns under the short presents of the layer above
+
+    The layers are aligned to their top, which leaves space under the shorter presents.  The presents at the start
+    of a layer go in that space until one doesn't fit, or order_tolerance presents have gone in.
+    Those presents end up below all of the presents of the layer above, and above all of the presents of their
+    own layer.  Each present goes in a gap with a top no higher than the one before, so the order doesn't change.
+    """
+    outfile = 'sub_topdown_gaps.csv'
+    order_tolerance = 100
+    # Each layer depends on the gaps of the layer above, so it can't be packed on its own
+    parallel = False
+    # The gaps of the layer above aren't saved with checkpoints
+    resumable = False
+
+    def __init__(self):
+        super(TopDownGapFilling, self).__init__()
+        self.gaps = classes.ResidualSpaceIndex()
+        # Presents put in the gaps of the last closed layer, kept with the current layer
+        self.in_gaps = []
+        self.filling_gaps = False
+
+    def process_present(self, present, layer):
+        if self.filling_gaps and len(self.in_gaps) < self.order_tolerance and \
+                self.gaps.place_present(present, max_top=self.in_gaps[-1].zmax):
+            self.in_gaps.append(present)
+            return layer
+        self.filling_gaps = False
+        present.rotate_shortest_z()
+        if not layer.place_present(present):
+            self.close_layer(layer)
+            layer = self.layer_class()
+            if self.gaps.place_present(present):
+                self.in_gaps.append(present)
+                self.filling_gaps = True
+            else:
+                layer.place_present(present)
+        return layer
+
+    def close_layer(self, layer):
+        layer.flip_layer()
+        presents = layer.presents.values()
+        self.sleigh.add_layer(layer, self.in_gaps)
+        self.in_gaps = []
+        # The layer is in place now, so the gaps can be found
+        self.gaps.clear()
+        self.gaps.add_below(presents, layer.z)
+
+    def process_last_layer(self, layer):
+        self.close_layer(layer)
+        self.shift_to_positive_z()
+
+
+class TopDownWindowPacking(TopDownLayerPacking):
+    """
+    Packs each layer from a window of the next presents, placed in a better order than they are read
+
+    All of the presents in a layer end up with the same top, so as long as a layer holds a run of consecutive presents,
+    the order they are placed in doesn't change the order term.  The window starts with as many presents as could
+    fit in a layer by area, found with a running sum of the areas.  The window is packed largest area first,
+    and if some of the presents don't fit, the window is shrunk by that many and packed again.
+    """
+    sleigh_class = classes.ReverseLayerSleigh
+    layer_class = classes.MaxRectsLayer
+    infile = 'presents.csv'
+    outfile = 'sub_topdown_window.csv'
+    log_at = 10000
+    # Rotate all of the presents so that their z is smallest, as in TopDownMaxRectShortestZ
+    shortest_z = True
+    max_window = 2000
+    # The workers would pack one present at a time, without the window or its rotations
+    parallel = False
+
+    def load(self):
+        super(TopDownWindowPacking, self).load()
+        if self.shortest_z:
+            self.presents.rotate_shortest_z()
+
+    def place_presents(self, start, check, write):
+        n = len(self.presents)
+        logger.info("Placing presents")
+        while start < n:
+            end = self.window_end(start)
+            rows = np.arange(start, end)
+            dims = self.presents.dims[start:end].copy()
+            layer, missed = self.pack_window(start, end)
+            while missed:
+                # Put the presents back as they were, so that a window only depends on where it starts
+                self.presents.set_placements(rows, dims, np.ones_like(dims))
+                end -= missed
+                layer, missed = self.pack_window(start, end)
+
+            layer.flip_layer()
+            self.sleigh.add_layer(layer)
+            self.save_checkpoint(end)
+            if start // self.log_at != end // self.log_at:
+                projected = self.sleigh.projected_score()
+                logger.info("Placed {} presents. Projected score is {}".format(end, projected))
+                self.log_stats()
+                if self.max_projected_score is not None and projected > self.max_projected_score:
+                    logger.warn("Projected score is over {}, stopping".format(self.max_projected_score))
+                    self.aborted = True
+                    return self
+            start = end
+
+        self.shift_to_positive_z()
+        logger.info("Finished placing presents")
+
+        if write:
+            self.write()
+
+        if check:
+            self.check()
+        return self
+
+    def window_end(self, start):
+        """
+        End of the window starting at row start: the most presents that could fit in a layer by area
+        """
+        if self.shortest_z:
+            # The presents are lying flat, so their footprints are the max_area of the statistics
+            count = min(self.present_stats.fit_count(start, name='max_area'), self.max_window)
+            return start + max(count, 1)
+        dims = self.presents.dims[start:start + self.max_window].astype(np.int64)
+        areas = np.cumsum(dims[:, 0] * dims[:, 1])
+        return start + max(int(np.searchsorted(areas, classes.MAX_X * classes.MAX_Y, side='right')), 1)
+
+    def pack_window(self, start, end):
+        """
+        Packs the presents in rows start to end into a new layer, largest area first, then tallest
+        Returns the layer and the number of presents that didn't fit
+        """
+        dims = self.presents.dims[start:end].astype(np.int64)
+        order = np.lexsort((-dims[:, 2], -dims[:, 0] * dims[:, 1]))
+        layer = self.layer_class()
+        missed = 0
+        for row in (order + start).tolist():
+            if not layer.place_present(self.presents.view(row)):
+                missed += 1
+        return layer, missed
+
+
+class TopDownWindowHeightPacking(TopDownWindowPacking):
+    """
+    TopDownWindowPacking, choosing the orientation of each present so that the layers hold more
+
+    A layer is as tall as its tallest present, so there is room above the shorter presents.
+    The layer height is set by laying the window flat, shortest side up, and taking the tallest present.
+    Then each present in the window is stood in the orientation with the smallest footprint that isn't taller
+    than the layer.  The window stops before the first present that is taller than the layer even lying flat,
+    which groups presents of similar heights into the same layer.
+    """
+    outfile = 'sub_topdown_window_height.csv'
+    # The six orientations, as the indices of the x, y and z sides in the sorted dimensions
+    orientations = np.array([(1, 2, 0), (2, 1, 0), (0, 2, 1), (2, 0, 1), (0, 1, 2), (1, 0, 2)])
+
+    def window_end(self, start):
+        n = min(len(self.presents), start + self.max_window) - start
+        sides = np.sort(self.presents.dims[start:start + n].astype(np.int64), axis=1)
+
+        # Height of the layer from the window of the presents lying flat
+        flat_areas = np.cumsum(sides[:, 1] * sides[:, 2])
+        flat_end = max(int(np.searchsorted(flat_areas, classes.MAX_X * classes.MAX_Y, side='right')), 1)
+        height = sides[:flat_end, 0].max()
+
+        # Footprint of every present in every orientation, and the smallest one that isn't taller than the layer
+        oriented = sides[:, self.orientations]
+        footprints = np.where(oriented[:, :, 2] <= height, oriented[:, :, 0] * oriented[:, :, 1], np.iinfo(np.int64).max)
+        best = np.argmin(footprints, axis=1)
+        too_tall = np.flatnonzero(sides[:, 0] > height)
+        if len(too_tall):
+            n = too_tall[0]
+
+        dims = oriented[np.arange(n), best[:n]]
+        areas = np.cumsum(dims[:, 0] * dims[:, 1])
+        end = start + max(int(np.searchsorted(areas, classes.MAX_X * classes.MAX_Y, side='right')), 1)
+        rows = np.arange(start, end)
+        self.presents.set_placements(rows, dims[:end - start], self.presents.positions[start:end].copy())
+        return end
+
+
 class ZMapPacking(Packing):
-    sleigh_class = classes.ZMapSleigh
+    sleigh_class = classes.SkylineZMapSleigh
     infile = 'presents.csv'
     outfile = 'sub_zmap_1.csv'
-    log_at = 100
+    log_at = 10000
 
     def run(self, check=True, write=True):
-        presents_file = os.path.join('data', self.infile)
-        outfile = os.path.join('data', self.outfile)
-        logger.info("Reading and placing presents")
-        counter = 0
-        with open(presents_file, 'rb') as presents:
-            presents.readline()  # skip header
-            read = csv.reader(presents)
-            for row in read:
-                present = classes.Present(*row)
+        self.start_instrumentation()
+        try:
+            outfile = os.path.join('data', self.outfile)
+            self.presents = self.load_presents()
+            logger.info("Placing presents")
+            counter = 0
+            for present in self.presents:
                 position = self.sleigh.place_present(present)
                 counter += 1
                 if counter % self.log_at == 0:
                     logger.info("Placed {} presents".format(counter))
-                    logger.info("Current min z is {}".format(np.min(self.sleigh.z_map)))
+                    logger.info("Current min z is {}".format(self.sleigh.min_z))
+                    self.log_stats()
 
-        logger.info("Finished placing presents")
+            self.sleigh.reverse()
+            logger.info("Finished placing presents")
 
-        if write:
-            self.write()
+            if write:
+                self.write()
 
-        if check:
-            self.check()
+            if check:
+                self.check()
 
-        return self
+            return self
+        finally:
+            self.stop_instrumentation()
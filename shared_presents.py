@@ -0,0 +1,135 @@
+"""
+Present tables in shared memory, so that worker processes don't each load their own copy
+
+    with shared_presents.published_files(['data/presents.csv']):
+        pool = multiprocessing.Pool(initializer=shared_presents.install, initargs=(shared_presents.published(),))
+        ...
+
+In the workers, shared_presents.attach('data/presents.csv') returns a read-only (N, 4) array of the published table,
+without copying it.  Packing.load_presents uses it when the file it would read has been published, and the
+PresentTable keeps the pids and dimensions in the shared memory, with only the placements in each worker.
+Each table keeps the cache key of the file it was loaded from, as in load_presents, and is ignored once the file
+changes.  Unpublish tables when the workers are done with them, so that later runs read the file again, as published_files
+does at the end of the with block.
+
+The tables are multiprocessing.RawArrays, as Python 2 has no multiprocessing.shared_memory.  They can't be pickled,
+so workers get them when they start: forked processes inherit them, and install passes them on as Pool initargs.
+"""
+import contextlib
+import ctypes
+import multiprocessing
+import os
+import numpy as np
+from classes import load_presents, presents_cache_key, logger
+
+# Absolute path of the presents file to its SharedPresents
+_published = {}
+
+
+class SharedPresents(object):
+    """
+    An (N, 4) array of pid, dim1, dim2, dim3 in shared memory
+    key is the presents_cache_key of the file the presents were loaded from
+    """
+
+    def __init__(self, presents, key=None):
+        self.key = key
+        presents = np.asarray(presents, dtype=np.int32)
+        self.shape = presents.shape
+        self.buffer = multiprocessing.RawArray(ctypes.c_int32, presents.size)
+        np.frombuffer(self.buffer, dtype=np.int32).reshape(self.shape)[...] = presents
+
+    def __len__(self):
+        return self.shape[0]
+
+    def attach(self, reverse=False):
+        """
+        Read-only view of the table, back to front if reverse is True
+        """
+        presents = np.frombuffer(self.buffer, dtype=np.int32).reshape(self.shape)
+        presents.flags.writeable = False
+        if reverse:
+            presents = presents[::-1]
+        return presents
+
+
+def _current(presents_file):
+    """
+    SharedPresents of a presents file, or None if it hasn't been published or the file changed since
+    """
+    shared = _published.get(os.path.abspath(presents_file))
+    if shared is None or shared.key != presents_cache_key(presents_file):
+        return None
+    return shared
+
+
+def is_published(presents_file):
+    return _current(presents_file) is not None
+
+
+def publish(presents_file):
+    """
+    Loads a presents file into shared memory, once, and again if the file changes.  Returns its SharedPresents
+    Call before starting the worker processes.
+    """
+    shared = _current(presents_file)
+    if shared is None:
+        shared = SharedPresents(load_presents(presents_file), presents_cache_key(presents_file))
+        _published[os.path.abspath(presents_file)] = shared
+        logger.info('Published {} presents from {}'.format(len(shared), presents_file))
+    return shared
+
+
+def published():
+    """
+    Dictionary of the published tables, to pass to install
+    """
+    return dict(_published)
+
+
+def install(tables):
+    """
+    Makes the tables from published() available in this process, e.g. as the initializer of a Pool
+    """
+    _published.update(tables)
+
+
+def attach(presents_file, reverse=False):
+    """
+    Read-only array of a published presents file, or None if it hasn't been published or the file changed since
+    """
+    shared = _current(presents_file)
+    if shared is None:
+        return None
+    return shared.attach(reverse)
+
+
+def unpublish(presents_file):
+    """
+    Forgets the table of a presents file
+    """
+    _published.pop(os.path.abspath(presents_file), None)
+
+
+@contextlib.contextmanager
+def published_files(presents_files):
+    """
+    Publishes the presents files for the with block, and unpublishes the ones that weren't already published
+    """
+    published_here = []
+    try:
+        for presents_file in presents_files:
+            if not is_published(presents_file):
+                published_here.append(presents_file)
+            publish(presents_file)
+        yield
+    finally:
+        for presents_file in published_here:
+            unpublish(presents_file)
+
+
+def clear():
+    """
+    Forgets the published tables.  Their memory is freed once no process refers to them
+    """
+    _published.clear()
@@ -0,0 +1,171 @@
+"""
+Runs a grid of packing configurations in a pool of processes and collects the results into one table
+
+    python sweep.py --packings TopDownMaxRect TopDownMaxRectShortestZ --layers MaxRectsLayer ArrayMaxRectsLayer \\
+        --rotations default shortest_z --heuristics none best_area_fit contact_point --out sweep.csv
+
+Every combination of the options is a configuration:
+    packing: a Packing class in run
+    layer: a Layer class in classes to use instead of the packing's layer_class, or default
+    rotation: default leaves the presents as the packing turns them,
+              shortest_z lays all of the presents flat before packing, as Present.rotate_shortest_z
+    heuristic: a placement heuristic in classes.HEURISTICS for layers that have one, or none
+    infile: presents file in the data directory
+    order: forward, or reverse to read the presents file back to front
+Combinations that don't make sense, e.g. a heuristic for a layer without one, are left out.
+
+The presents files are loaded into shared memory once, before the pool starts, and the workers read them from there.
+"""
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import time
+import classes
+import present_stats
+import run
+import shared_presents
+import MetricCalculation
+from classes import logger
+
+ROTATIONS = ['default', 'shortest_z']
+ORDERS = ['forward', 'reverse']
+COLUMNS = ['packing', 'layer', 'rotation', 'heuristic', 'infile', 'order',
+           'score', 'height_term', 'order_term', 'seconds', 'error']
+
+
+def make_grid(packings, layers=('default',), rotations=('default',), heuristics=('none',),
+              infiles=('presents.csv',), orders=('forward',)):
+    """
+    List of configuration dicts, one for each combination that can be run
+    """
+    configs = []
+    for packing, layer, rotation, heuristic, infile, order in itertools.product(
+            packings, layers, rotations, heuristics, infiles, orders):
+        packing_class = getattr(run, packing)
+        layered = issubclass(packing_class, run.LayerPacking)
+        layer_class = packing_class.layer_class if layered and layer == 'default' else getattr(classes, layer, None)
+        if not layered and (layer, rotation, heuristic) != ('default', 'default', 'none'):
+            logger.warn('{} has no layers, leaving out {}, {}, {}'.format(packing, layer, rotation, heuristic))
+            continue
+        if heuristic != 'none' and not hasattr(layer_class, 'heuristic'):
+            logger.warn('{} has no placement heuristic, leaving out {}'.format(layer_class.__name__, heuristic))
+            continue
+        configs.append({
+            'packing': packing,
+            'layer': layer,
+            'rotation': rotation,
+            'heuristic': heuristic,
+            'infile': infile,
+            'order': order,
+        })
+    return configs
+
+
+def make_packing(config):
+    """
+    Packing instance set up as in config
+    """
+    packing = getattr(run, config['packing'])()
+    packing.infile = config['infile']
+    packing.reverse = config['order'] == 'reverse'
+    if config['layer'] != 'default':
+        packing.layer_class = getattr(classes, config['layer'])
+    if config['heuristic'] != 'none':
+        layer_class = packing.layer_class
+        packing.layer_class = type(layer_class.__name__, (layer_class,),
+                                   {'heuristic': classes.HEURISTICS[config['heuristic']]()})
+    return packing
+
+
+def run_config(config):
+    """
+    Packs the presents as in config, and returns a row of the results table
+    Runs in the worker processes, so errors are returned in the row instead of stopping the sweep
+    """
+    result = dict(config, score=None, height_term=None, order_term=None, seconds=None, error='')
+    try:
+        packing = make_packing(config)
+        start = time.time()
+        if isinstance(packing, run.LayerPacking):
+            packing.load()
+            if config['rotation'] == 'shortest_z':
+                packing.presents.rotate_shortest_z()
+            packing.place_presents(0, check=False, write=False)
+        else:
+            packing.run(check=False, write=False)
+        result['seconds'] = time.time() - start
+        rows = classes.boxes_to_rows(packing.sleigh.output_boxes())
+        result['score'], result['height_term'], result['order_term'] = MetricCalculation.score_submission(rows)
+    except Exception as e:
+        logger.exception('Configuration {} failed'.format(config))
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def run_sweep(configs, processes=None):
+    """
+    Runs the configurations in a pool of processes, each in a fresh process
+    Returns the rows of the results table, in the order of configs
+    """
+    # Load the presents before the workers start, so they share one copy, and build the statistics caches,
+    # so the workers don't race to write them
+    presents_files = [os.path.join('data', infile) for infile in sorted(set(config['infile'] for config in configs))]
+    with shared_presents.published_files(presents_files):
+        for presents_file in presents_files:
+            present_stats.PresentStats.from_csv(presents_file)
+
+        logger.info('Running {} configurations'.format(len(configs)))
+        pool = multiprocessing.Pool(processes, initializer=shared_presents.install,
+                                    initargs=(shared_presents.published(),), maxtasksperchild=1)
+        results = []
+        try:
+            for result in pool.imap(run_config, configs):
+                if result['error']:
+                    logger.error('{packing} {layer} {rotation} {heuristic} {infile} {order}: {error}'.format(**result))
+                else:
+                    logger.info('{packing} {layer} {rotation} {heuristic} {infile} {order}: score {score}, '
+                                '{seconds:.1f} s'.format(**result))
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def write_results(filename, results):
+    with open(filename, 'wb') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def format_results(results):
+    """
+    Results as an aligned text table, best score first
+    """
+    ranked = sorted(results, key=lambda r: (r['score'] is None, r['score']))
+    rows = [COLUMNS] + [['' if r[c] is None else '{:.1f}'.format(r[c]) if c == 'seconds' else str(r[c])
+                         for c in COLUMNS] for r in ranked]
+    widths = [max(len(row[i]) for row in rows) for i in xrange(len(COLUMNS))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--packings', nargs='+', default=['TopDownMaxRect', 'TopDownMaxRectShortestZ'])
+    parser.add_argument('--layers', nargs='+', default=['default'])
+    parser.add_argument('--rotations', nargs='+', default=['default'], choices=ROTATIONS)
+    parser.add_argument('--heuristics', nargs='+', default=['none'], choices=['none'] + sorted(classes.HEURISTICS))
+    parser.add_argument('--infiles', nargs='+', default=['presents.csv'])
+    parser.add_argument('--orders', nargs='+', default=['forward'], choices=ORDERS)
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes, default one per CPU')
+    parser.add_argument('--out', default='sweep.csv', help='CSV file to write the results table to')
+    args = parser.parse_args()
+
+    configs = make_grid(args.packings, args.layers, args.rotations, args.heuristics, args.infiles, args.orders)
+    results = run_sweep(configs, args.processes)
+    write_results(args.out, results)
+    print format_results(results)
+    logger.info('Results written to {}'.format(args.out))
@@ -0,0 +1,123 @@
+"""
+Checks a submission file against presents.csv
+
+    python validate.py data/sub_topdown_3.csv data/presents.csv
+
+Every check is done on all of the presents at once with array operations, and every violation is reported,
+not just the first:
+    - the ids: each present in presents.csv appears exactly once, and no other ids appear
+    - the vertices of each present are the eight corners of a box
+    - the box has the dimensions of the present in presents.csv, in some rotation
+    - the box is inside the sleigh
+    - no two boxes overlap
+"""
+import argparse
+import collections
+import sys
+import numpy as np
+from classes import MAX_X, MAX_Y, load_presents, find_collisions, logger
+from MetricCalculation import read_submission_array, submission_extents, score_submission
+
+# Number of violations of each kind to print
+SHOW = 10
+
+
+def check_ids(submission, presents):
+    """
+    Returns arrays of the ids that appear more than once, the ids in presents.csv that are missing,
+    and the ids that aren't in presents.csv
+    """
+    pids = np.sort(submission[:, 0])
+    duplicates = np.unique(pids[1:][pids[1:] == pids[:-1]])
+    unique = np.unique(pids)
+    expected = np.unique(presents[:, 0])
+    missing = np.setdiff1d(expected, unique, assume_unique=True)
+    unknown = np.setdiff1d(unique, expected, assume_unique=True)
+    return duplicates, missing, unknown
+
+
+def check_boxes(submission, mins, maxs):
+    """
+    Returns the ids of the presents whose vertices aren't the eight corners of a box with sides of at least 2
+    """
+    vertices = submission[:, 1:].reshape(-1, 8, 3)
+    at_min = vertices == mins[:, np.newaxis, :]
+    at_max = vertices == maxs[:, np.newaxis, :]
+    # Which corner each vertex is, which has to be a different one for each of the vertices
+    corners = np.sort((at_max * [4, 2, 1]).sum(axis=2), axis=1)
+    valid = (np.all(at_min | at_max, axis=(1, 2)) & np.all(corners == np.arange(8), axis=1) &
+             np.all(maxs > mins, axis=1))
+    return submission[~valid, 0]
+
+
+def check_dimensions(submission, mins, maxs, presents):
+    """
+    Returns the ids of the presents whose box doesn't match the dimensions in presents.csv under any rotation
+    Ids that aren't in presents.csv are left to check_ids.
+    """
+    presents = presents[np.argsort(presents[:, 0])]
+    rows = np.searchsorted(presents[:, 0], submission[:, 0]).clip(0, len(presents) - 1)
+    known = presents[rows, 0] == submission[:, 0]
+    expected = np.sort(presents[rows, 1:], axis=1)
+    actual = np.sort(maxs - mins + 1, axis=1)
+    return submission[known & np.any(actual != expected, axis=1), 0]
+
+
+def check_bounds(submission, mins, maxs):
+    """
+    Returns the ids of the presents that are outside of the sleigh
+    """
+    outside = ((mins[:, 0] < 1) | (mins[:, 1] < 1) | (mins[:, 2] < 1) |
+               (maxs[:, 0] > MAX_X) | (maxs[:, 1] > MAX_Y))
+    return submission[outside, 0]
+
+
+def validate(submission, presents):
+    """
+    Checks an (N, 25) submission array against an (N, 4) presents array
+    Returns an OrderedDict of the name of each check to an array of the ids, or pairs of ids, that fail it
+    """
+    mins, maxs = submission_extents(submission)
+    duplicates, missing, unknown = check_ids(submission, presents)
+    violations = collections.OrderedDict()
+    violations['duplicate ids'] = duplicates
+    violations['missing ids'] = missing
+    violations['unknown ids'] = unknown
+    violations['not boxes'] = check_boxes(submission, mins, maxs)
+    violations['wrong dimensions'] = check_dimensions(submission, mins, maxs, presents)
+    violations['outside the sleigh'] = check_bounds(submission, mins, maxs)
+    violations['collisions'] = find_collisions(np.column_stack([submission[:, 0], mins, maxs]))
+    return violations
+
+
+def validate_file(submission_file, presents_file):
+    """
+    Checks a submission file against a presents file and logs the violations
+    Returns the violations, or None if the file couldn't be read as rows of 25 integers
+    """
+    presents = load_presents(presents_file)
+    try:
+        submission = read_submission_array(submission_file)
+    except ValueError:
+        logger.error('{} is not made of rows of 25 integers'.format(submission_file))
+        return None
+    logger.info('Checking {} presents'.format(len(submission)))
+    violations = validate(submission, presents)
+    for name, found in violations.items():
+        if len(found):
+            shown = ', '.join(str(v) for v in found[:SHOW].tolist())
+            logger.error('{} {}: {}{}'.format(len(found), name, shown, ', ...' if len(found) > SHOW else ''))
+    if not any(len(found) for found in violations.values()):
+        metric, height_term, order_term = score_submission(submission)
+        logger.info('Submission is valid. Metric = {} = 2 * height term: {} + order term: {}'.format(
+            metric, height_term, order_term))
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('submission')
+    parser.add_argument('presents', nargs='?', default='data/presents.csv')
+    args = parser.parse_args()
+    violations = validate_file(args.submission, args.presents)
+    sys.exit(1 if violations is None or any(len(found) for found in violations.values()) else 0)